@@ -1,45 +1,177 @@
 
 '''
-This script is for acquiring credentials and/or generating a token for an ArcGIS Server. Requires admin credentials to successfully run. 
-Use with conjunction in other scripts. 
+This script is for acquiring credentials and/or generating a token for an ArcGIS Server. Requires admin credentials to successfully run.
+Use with conjunction in other scripts.
 
-Requirements: Python 3+, Admin account for Arcgis Server, AGOL or Portal depending on how you run it
+Credentials are only prompted for once per run. Tokens are cached per token URL and only handed out again while most of
+their lifetime is left, since the scripts keep a site's token for the whole crawl. Server objects are shared per site so
+each site is only logged in to once per run.
+
+Tokens can also be cached on disk between runs (e.g. for scheduled runs). The disk cache is encrypted and only used when
+the ARCGIS_TOKEN_CACHE_KEY environment variable holds a Fernet key, which can be created with:
+
+    python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+
+The cache file defaults to ~/.arcgis_token_cache and can be moved with the ARCGIS_TOKEN_CACHE environment variable.
+
+Requirements: Python 3+, Admin account for Arcgis Server, AGOL or Portal depending on how you run it, cryptography for the disk cache
 '''
 import getpass
-import requests
+import json
+import os
+import threading
+import time
+from arcgis.gis.server import Server
+import Transport_ArcGISServer  # custom script
+import Instrument_ArcGISServer  # custom script
+
+TOKEN_EXPIRATION = 60  # minutes a generated token is valid for
+MIN_TOKEN_LIFETIME = TOKEN_EXPIRATION * 45  # seconds a cached token must have left to be reused (three quarters)
+DISK_CACHE_TTL = 3600  # seconds a token in the disk cache is trusted for
+CACHE_KEY_ENV = 'ARCGIS_TOKEN_CACHE_KEY'
+CACHE_PATH_ENV = 'ARCGIS_TOKEN_CACHE'
+
+_creds = {}
+_tokens = {}
+_servers = {}
+_server_locks = {}
+_server_factory = Server
+_lock = threading.RLock()
 
 #get credentials
-def get_creds():
-    print(f"\nEnter GIS Admin Credentials:")
-    username = getpass.getpass(prompt="User account: ")  
-    password = getpass.getpass(prompt='Account password: ')
-    return username, password
+def get_creds(site=None):
+    with _lock:
+        if 'username' not in _creds:
+            print(f"\nEnter GIS Admin Credentials{f' for {site}' if site else ''}:")
+            _creds['username'] = getpass.getpass(prompt="User account: ")
+            _creds['password'] = getpass.getpass(prompt='Account password: ')
+        return _creds['username'], _creds['password']
+
+# Check a cached token still has most of its lifetime left, a crawl keeps its token from start to finish
+def _token_valid(entry):
+    now = time.time()
+    return entry['expires'] / 1000 - MIN_TOKEN_LIFETIME > now and entry.get('saved', now) + DISK_CACHE_TTL > now
+
+# Get the Fernet cipher for the disk cache, returns None when the disk cache is not enabled
+def _disk_cipher():
+    key = os.environ.get(CACHE_KEY_ENV)
+    if not key:
+        return None
+    try:
+        from cryptography.fernet import Fernet
+        return Fernet(key.encode())
+    except Exception as e:
+        print(f"Token disk cache disabled: {str(e)}")
+        return None
+
+def _disk_path():
+    return os.environ.get(CACHE_PATH_ENV, os.path.join(os.path.expanduser('~'), '.arcgis_token_cache'))
+
+def _read_disk_cache(cipher):
+    try:
+        with open(_disk_path(), 'rb') as cache_file:
+            return json.loads(cipher.decrypt(cache_file.read()))
+    except Exception:
+        return {}
+
+def _write_disk_cache(cipher, token_url, entry):
+    cache = {url: cached for url, cached in _read_disk_cache(cipher).items() if _token_valid(cached)}
+    cache[token_url] = entry
+    path = _disk_path()
+    with open(path, 'wb') as cache_file:
+        cache_file.write(cipher.encrypt(json.dumps(cache).encode()))
+    os.chmod(path, 0o600)
+
+# Get a cached token for a token URL from memory or the disk cache
+def get_cached_token(token_url):
+    with _lock:
+        entry = _tokens.get(token_url)
+        if entry and _token_valid(entry):
+            return entry['token']
+
+        cipher = _disk_cipher()
+        if cipher:
+            entry = _read_disk_cache(cipher).get(token_url)
+            if entry and _token_valid(entry):
+                _tokens[token_url] = entry
+                return entry['token']
+
+    return None
 
 #generate token
-def get_token(site, token_url):
+# A valid cached token is returned without prompting, so username and password are only prompted for when a new token
+# has to be generated and are returned as given (possibly None) with a cached token
+def get_token(site, token_url, username=None, password=None):
     try:
-        username, password = get_creds()
+        token = get_cached_token(token_url)
+        if token:
+            return username, password, token
+
+        if username is None or password is None:
+            username, password = get_creds(site)
 
         payload = {
             'f': 'json',
             'username': username,
             'password': password,
-            'client': "requestip"
+            'client': "requestip",
+            'expiration': TOKEN_EXPIRATION
         }
-        response = requests.post(token_url, data=payload)
-        
+        with Instrument_ArcGISServer.span('token', token_url):
+            response = Transport_ArcGISServer.post(token_url, data=payload)
+
         if response.status_code != 200:
                 print(f"Error: Unable to retrieve token. HTTP Status code: {response.status_code}")
                 return None
 
-        token = response.json().get('token')
+        token_json = response.json()
+        token = token_json.get('token')
 
         if not token:
             print("Error: Token not found in the response.")
             return None
 
+        # Cache the token until it expires
+        expires = token_json.get('expires', (time.time() + TOKEN_EXPIRATION * 60) * 1000)
+        entry = {'token': token, 'expires': expires, 'saved': time.time()}
+        with _lock:
+            _tokens[token_url] = entry
+            cipher = _disk_cipher()
+            if cipher:
+                _write_disk_cache(cipher, token_url, entry)
+
         return username, password, token
 
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         return None
+
+# Get the shared Server instance for a site, each site is only logged in to once per run.
+# The login runs under a lock for the site only, so a slow or dead site doesn't hold up the logins and tokens of others.
+def get_server(admin_url, username, password):
+    key = (admin_url, username)
+    with _lock:
+        if key in _servers:
+            return _servers[key]
+        site_lock = _server_locks.setdefault(key, threading.Lock())
+
+    with site_lock:
+        with _lock:
+            if key in _servers:
+                return _servers[key]
+            factory = _server_factory
+
+        with Instrument_ArcGISServer.span('login', admin_url):
+            server = factory(url=admin_url, username=username, password=password)
+
+        with _lock:
+            _servers[key] = server
+        return server
+
+# Set the function get_server creates a site's Server with (called with url, username and password), e.g. to stand in
+# a fake server for benchmarks. None restores the arcgis Server. The shared Server instances are dropped.
+def set_server_factory(factory):
+    global _server_factory
+    with _lock:
+        _server_factory = factory or Server
+        _servers.clear()
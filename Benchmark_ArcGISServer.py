@@ -0,0 +1,410 @@
+'''
+This script benchmarks the crawler against a local fake ArcGIS Server, so throughput can be measured and regressions
+caught without touching a live site. The fake server imitates the endpoints the scripts use:
+
+    {admin}                                                   admin root
+    {admin}/generateToken                                     token
+    {admin}/services, {admin}/services/{folder}               folder and service lists
+    {admin}/services/{folder}/report                          admin services report (--bulk_listing)
+    {admin}/services/{folder}/{service}.{type}                service JSON
+    {admin}/services/{folder}/{service}.{type}/iteminfo/manifest/manifest.xml
+    {admin}/usagereports/quickReport                          quick report query
+    {rest}/{folder}/{service}/{type}/info/metadata            metadata with the CreaDate and an ETag
+
+The synthetic site size (folders, services per folder, datasets per manifest) and the injected latency and error rate
+are set from the command line. Each benchmark is run --repeat times and the timings can be saved to JSON and compared
+to an earlier run, the script exits with an error when a benchmark is slower than the baseline by more than --tolerance.
+
+    Benchmark_ArcGISServer.py --folders 20 --services 25 --latency 0.02 --out_json "C:\...\bench.json"
+    Benchmark_ArcGISServer.py --folders 20 --services 25 --latency 0.02 --baseline "C:\...\bench.json"
+
+The benchmarks:
+
+    details    - get_service_details with --bulk_listing and export_to_csv
+    usage      - iter_quick_reports with --batch_size, streamed to the CSV
+    manifest   - get_manifest with --bulk_listing and parse_xml_to_df
+    clean      - CleanQuickReportUsageData full and incremental merges of a synthetic report
+
+Requirements: Python 3+, same as the scripts it runs
+'''
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import click
+import pandas as pd
+import Authenticate_ArcGISServer  # custom script
+from CrawlServices_ArcGISServer import ReportService, DEFAULT_MAX_WORKERS  # custom script
+import Transport_ArcGISServer  # custom script
+import Instrument_ArcGISServer  # custom script
+import GetServiceDetails_ArcGISServer  # custom script
+import GetServiceUsage_ArcGIS_Server  # custom script
+import GetManifestXML_ArcGISServer  # custom script
+import CleanQuickReportUsageData  # custom script
+
+SITE = 'bench'
+USERNAME = 'bench'
+PASSWORD = 'bench'
+SERVICE_TYPES = ['MapServer', 'FeatureServer', 'ImageServer']
+TIME_SLICES = 365  # daily slices in a LAST_YEAR quick report
+
+# Synthetic site served by the fake server, everything is generated up front from the seed
+class FakeSite:
+    def __init__(self, folders=10, services=20, datasets=5, seed=0):
+        rng = random.Random(seed)
+        self.folders = [f"Folder{index:03d}" for index in range(folders)]
+        self.services = {
+            folder: [(f"Service{index:04d}", rng.choice(SERVICE_TYPES)) for index in range(services)]
+            for folder in self.folders
+        }
+        self.datasets = datasets
+        start = int(pd.Timestamp('2024-01-01').timestamp() * 1000)
+        self.time_slices = [start + day * 86400000 for day in range(TIME_SLICES)]
+        self.rng = rng
+
+    def service_count(self):
+        return sum(len(services) for services in self.services.values())
+
+    def service_json(self, folder, name, type):
+        return {
+            'serviceName': name,
+            'type': type,
+            'description': f"{name} in {folder}",
+            'private': False,
+            'properties': {'maxRecordCount': '2000'},
+            'extensions': [
+                {'typeName': 'FeatureServer', 'enabled': 'true' if type == 'FeatureServer' else 'false'},
+                {'typeName': 'KmlServer', 'enabled': 'false'},
+                {'typeName': 'WFSServer', 'enabled': 'false'},
+                {'typeName': 'WMSServer', 'enabled': 'true'},
+            ],
+        }
+
+    def report_json(self, folder, name, type):
+        service = self.service_json(folder, name, type)
+        return {
+            'serviceName': name,
+            'type': type,
+            'description': service['description'],
+            'isPrivate': service['private'],
+            'properties': service['properties'],
+            'extensions': service['extensions'],
+            'iteminfo': {},
+        }
+
+    def manifest_xml(self, folder, name):
+        datasets = ''.join(
+            f"<SVCDataset><Name>{name}_FC{index}</Name><DatasetType>esriDTFeatureClass</DatasetType>"
+            f"<OnPremisePath>\\\\gisdata\\{folder}\\{name}.gdb\\{name}_FC{index}</OnPremisePath></SVCDataset>"
+            for index in range(self.datasets)
+        )
+        return (
+            "<SVCManifest><Databases><SVCDatabase><OnServerWorkspaceFactoryProgID>esriDataSourcesGDB.FileGDBWorkspaceFactory"
+            f"</OnServerWorkspaceFactoryProgID><Datasets>{datasets}</Datasets></SVCDatabase></Databases>"
+            f"<Resources><SVCResource><OnPremisePath>C:\\projects\\{folder}\\{name}.aprx</OnPremisePath></SVCResource></Resources>"
+            "</SVCManifest>"
+        ).encode()
+
+    def metadata_xml(self, name):
+        return f"<metadata><Esri><CreaDate>20240101</CreaDate><CreaTime>09000000</CreaTime></Esri><dataIdInfo><idCitation><resTitle>{name}</resTitle></idCitation></dataIdInfo></metadata>".encode()
+
+    def quick_report(self, queries):
+        report_data = [
+            {'resourceURI': query, 'data': [self.rng.randint(0, 500) for _ in self.time_slices]}
+            for query in queries.split(',')
+        ]
+        return {'report': {'time-slices': self.time_slices, 'report-data': [report_data]}}
+
+# Local HTTP server for a FakeSite, every response waits latency seconds and error_rate of them fail with a 503
+class FakeArcGISServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, site, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(('127.0.0.1', 0), FakeArcGISHandler)
+        self.site = site
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}/arcgis"
+
+    @property
+    def admin_url(self):
+        return f"{self.base_url}/admin"
+
+    @property
+    def rest_url(self):
+        return f"{self.base_url}/rest/services"
+
+    def server_info(self, max_workers=DEFAULT_MAX_WORKERS):
+        return {'admin': self.admin_url, 'rest': self.rest_url, 'access': 'Internal', 'max_workers': max_workers}
+
+    def inject_error(self):
+        with self.rng_lock:
+            return self.rng.random() < self.error_rate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeArcGISHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are written separately, don't let them wait on delayed ACKs
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type='application/json', status=200, headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request(parse_qs(urlsplit(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(urlsplit(self.path).query)
+        params.update(parse_qs(self.rfile.read(length).decode()))
+        self.handle_request(params)
+
+    def handle_request(self, params):
+        server = self.server
+        site = server.site
+        if server.latency:
+            time.sleep(server.latency)
+        if server.inject_error():
+            self.send_body({'error': {'code': 503, 'message': 'Injected error'}}, status=503)
+            return
+
+        path = urlsplit(self.path).path
+        parts = [part for part in path.split('/') if part][1:]  # drop the 'arcgis' web adaptor
+
+        if parts[:1] == ['rest']:
+            # rest/services/{folder}/{service}/{type}/info/metadata
+            if len(parts) == 7 and parts[5:] == ['info', 'metadata']:
+                # The metadata never changes, so a conditional request with its ETag gets a 304
+                etag = f'"{parts[3]}"'
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send_body(b'', 'application/xml', status=304, headers={'ETag': etag})
+                return self.send_body(site.metadata_xml(parts[3]), 'application/xml', headers={'ETag': etag})
+            return self.send_body({'error': {'code': 404}}, status=404)
+
+        parts = parts[1:]  # drop 'admin'
+        if not parts:
+            return self.send_body({'resources': ['services', 'usagereports', 'system'], 'currentVersion': 11.1})
+        if parts == ['generateToken']:
+            return self.send_body({'token': 'bench-token', 'expires': int((time.time() + 3600) * 1000)})
+        if parts == ['usagereports', 'quickReport']:
+            return self.send_body(site.quick_report(params.get('queries', [''])[0]))
+        if parts == ['services']:
+            return self.send_body({'folders': site.folders, 'services': []})
+
+        if parts[0] == 'services' and parts[1] in site.services:
+            folder = parts[1]
+            if len(parts) == 2:
+                return self.send_body({'folderName': folder, 'services': [
+                    {'folderName': folder, 'serviceName': name, 'type': type} for name, type in site.services[folder]
+                ]})
+            if parts[2:] == ['report']:
+                return self.send_body({'reports': [site.report_json(folder, name, type) for name, type in site.services[folder]]})
+
+            name, _, type = parts[2].partition('.')
+            if len(parts) == 3:
+                return self.send_body(site.service_json(folder, name, type))
+            if parts[3:] == ['iteminfo', 'manifest', 'manifest.xml']:
+                return self.send_body(site.manifest_xml(folder, name), 'application/xml')
+
+        self.send_body({'error': {'code': 404, 'message': f"Not found: {path}"}}, status=404)
+
+# Stands in for the arcgis Server object when crawling the fake server, with the services listing and quick report
+# calls the scripts make on it sent over HTTP through the transport
+class FakeServerServices:
+    def __init__(self, admin_url, token):
+        self.admin_url = admin_url
+        self.token = token
+
+    @property
+    def folders(self):
+        response = Transport_ArcGISServer.get(f"{self.admin_url}/services", params={'f': 'json', 'token': self.token})
+        return ['/'] + response.json()['folders']
+
+    def list(self, folder):
+        folder_url = f"{self.admin_url}/services/{folder}"
+        response = Transport_ArcGISServer.get(folder_url, params={'f': 'json', 'token': self.token})
+        services = []
+        for entry in response.json()['services']:
+            service_url = f"{folder_url}/{entry['serviceName']}.{entry['type']}"
+            properties = Transport_ArcGISServer.get(service_url, params={'f': 'json', 'token': self.token}).json()
+            services.append(ReportService(service_url, properties))
+        return services
+
+class FakeServerUsage:
+    def __init__(self, admin_url, token):
+        self.admin_url = admin_url
+        self.token = token
+
+    def quick_report(self, since, queries, metrics):
+        response = Transport_ArcGISServer.post(f"{self.admin_url}/usagereports/quickReport", data={
+            'f': 'json', 'token': self.token, 'since': since, 'queries': queries, 'metrics': metrics
+        })
+        response.raise_for_status()
+        return response.json()
+
+class FakeServer:
+    def __init__(self, admin_url, token):
+        self.services = FakeServerServices(admin_url, token)
+        self.usage = FakeServerUsage(admin_url, token)
+
+# Run func repeat times, returns the timings in seconds
+def time_runs(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def bench_details(fake, work_dir, max_workers, batch_size):
+    server_info = fake.server_info(max_workers)
+    rows = GetServiceDetails_ArcGISServer.get_service_details(
+        SITE, server_info['access'], 'map', fake.admin_url, fake.rest_url, USERNAME, PASSWORD, max_workers, bulk_listing=True
+    )
+    GetServiceDetails_ArcGISServer.export_to_csv(rows, work_dir, 'details.csv')
+
+def bench_usage(fake, work_dir, max_workers, batch_size):
+    rows = GetServiceUsage_ArcGIS_Server.iter_quick_reports(fake.admin_url, SITE, USERNAME, PASSWORD, max_workers, batch_size)
+    GetServiceUsage_ArcGIS_Server.write_usage_rows(rows, os.path.join(work_dir, 'usage.csv'))
+
+def bench_manifest(fake, work_dir, max_workers, batch_size):
+    rows = [row for service_rows in GetManifestXML_ArcGISServer.get_manifest(
+        USERNAME, PASSWORD, fake.admin_url, fake.rest_url, 'bench-token', max_workers, bulk_listing=True
+    ) for row in service_rows]
+    GetManifestXML_ArcGISServer.write_rows(rows, os.path.join(work_dir, 'manifest.csv'), header=True)
+
+# Write a master file with the first half of a year of usage and a new report with the whole year, then merge them
+def bench_clean(fake, work_dir, max_workers, batch_size):
+    site = fake.site
+    time_slices = pd.to_datetime(site.time_slices, unit='ms').strftime('%Y-%m-%d')
+    rows = pd.DataFrame([
+        {'Site': SITE, 'Directory': folder, 'Service': name, 'Service_Type': type, 'Time_Slice': list(time_slices),
+         'Request_Count': [site.rng.randint(0, 500) for _ in time_slices]}
+        for folder, services in site.services.items() for name, type in services
+    ]).explode(['Time_Slice', 'Request_Count'])
+
+    master_path = os.path.join(work_dir, 'master.csv')
+    new_path = os.path.join(work_dir, 'new.csv')
+    archive = os.path.join(work_dir, 'archive')
+    os.makedirs(archive, exist_ok=True)
+    half = time_slices[len(time_slices) // 2]
+
+    for merge in (CleanQuickReportUsageData.full_merge, CleanQuickReportUsageData.incremental_merge):
+        rows[rows['Time_Slice'] <= half].to_csv(master_path, index=False)
+        rows.to_csv(new_path, index=False)
+        if os.path.exists(f"{master_path}.hwm"):
+            os.remove(f"{master_path}.hwm")
+        merge(master_path, new_path, archive)
+
+BENCHMARKS = {
+    'details': bench_details,
+    'usage': bench_usage,
+    'manifest': bench_manifest,
+    'clean': bench_clean,
+}
+
+# Compare results to a baseline, returns the benchmarks that got slower by more than tolerance
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result['min_seconds'] > baseline[name]['min_seconds'] * (1 + tolerance):
+            regressions.append((name, baseline[name]['min_seconds'], result['min_seconds']))
+    return regressions
+
+# CLICK cmds
+@click.command()
+@Instrument_ArcGISServer.instrumented
+@click.option('--benchmark', 'benchmarks', type=click.Choice(list(BENCHMARKS)), multiple=True, default=list(BENCHMARKS), help='Benchmark to run, can be given more than once. Defaults to all of them.')
+@click.option('--folders', type=int, default=10, help='Folders on the fake site.')
+@click.option('--services', type=int, default=20, help='Services in each folder.')
+@click.option('--datasets', type=int, default=5, help='Datasets in each manifest.')
+@click.option('--latency', type=float, default=0.0, help='Seconds the fake server waits before each response.')
+@click.option('--error_rate', type=click.FloatRange(0, 1), default=0.0, help='Fraction of responses that fail with a 503.')
+@click.option('--max_workers', type=int, default=DEFAULT_MAX_WORKERS, help='Concurrent requests to the fake site.')
+@click.option('--batch_size', type=click.IntRange(min=1), default=1, help='Services per quick report query for the usage benchmark.')
+@click.option('--repeat', type=click.IntRange(min=1), default=3, help='Times each benchmark is run.')
+@click.option('--seed', type=int, default=0, help='Seed for the synthetic site and the injected errors.')
+@click.option('--out_json', type=click.Path(), default=None, help='Save the results to this JSON file.')
+@click.option('--baseline', type=click.Path(exists=True), default=None, help='Results JSON from an earlier run to compare against.')
+@click.option('--tolerance', type=float, default=0.2, help='Slowdown against the baseline allowed before a benchmark fails, 0.2 is 20%.')
+
+def main(benchmarks, folders, services, datasets, latency, error_rate, max_workers, batch_size, repeat, seed, out_json, baseline, tolerance):
+    site = FakeSite(folders, services, datasets, seed)
+    fake = FakeArcGISServer(site, latency, error_rate, seed).start()
+    Transport_ArcGISServer.configure(pool_size=max_workers, backoff=0.01)
+
+    # Log in to the fake server once, the scripts pick the token up from the Authenticate cache and get a FakeServer
+    # in place of the arcgis Server
+    Authenticate_ArcGISServer.get_token(SITE, f"{fake.admin_url}/generateToken", USERNAME, PASSWORD)
+    Authenticate_ArcGISServer.set_server_factory(lambda url, username, password: FakeServer(url, 'bench-token'))
+
+    click.echo(f"Fake site: {len(site.folders)} folders, {site.service_count()} services, {datasets} datasets per manifest, "
+               f"{latency}s latency, {error_rate:.0%} errors")
+
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for name in benchmarks:
+                with Instrument_ArcGISServer.span('benchmark', name):
+                    timings = time_runs(lambda: BENCHMARKS[name](fake, work_dir, max_workers, batch_size), repeat)
+                results[name] = {
+                    'min_seconds': min(timings),
+                    'mean_seconds': sum(timings) / len(timings),
+                    'services_per_second': site.service_count() / min(timings),
+                }
+    finally:
+        fake.stop()
+        Authenticate_ArcGISServer.set_server_factory(None)
+
+    click.echo("\nBenchmark results:")
+    for name, result in results.items():
+        click.echo(f"  {name}: min {result['min_seconds']:.3f}s, mean {result['mean_seconds']:.3f}s, "
+                   f"{result['services_per_second']:.0f} services/s")
+
+    if out_json:
+        with open(out_json, 'w') as json_file:
+            json.dump({'settings': {'folders': folders, 'services': services, 'datasets': datasets, 'latency': latency,
+                                    'error_rate': error_rate, 'max_workers': max_workers, 'batch_size': batch_size},
+                       'results': results}, json_file, indent=2)
+        click.echo(f"\nResults saved to {out_json}")
+
+    if baseline:
+        with open(baseline, 'r') as json_file:
+            regressions = find_regressions(results, json.load(json_file)['results'], tolerance)
+        for name, before, after in regressions:
+            click.echo(f"\nRegression: {name} took {after:.3f}s, the baseline was {before:.3f}s")
+        if regressions:
+            sys.exit(1)
+        click.echo(f"\nNo regressions against {baseline}")
+
+if __name__ == '__main__':
+    main()
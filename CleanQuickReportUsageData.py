@@ -1,68 +1,186 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-# This script cleans up ArcGIS Server quick reports on usage data for powerbi reporting 
+# This script cleans up ArcGIS Server quick reports on usage data for powerbi reporting
+# Can also be run in cmd line with the following:
 
-#TODO create CLI args 
+#     CleanQuickReportUsageData.py --new_path "C:\...\GIS_Services_map_Usage_....csv" --server_type "map" --incremental
+
+# By default the whole master file is archived, merged and rewritten. With --incremental only the new report is read,
+# the rows after the high-water mark (the latest Time_Slice in the master, kept in a .hwm sidecar file next to it) are
+# appended to the master and the archive gets a delta file of just the appended rows.
+# With --parquet_dir the new rows are also merged into the partitioned Parquet usage store, and with --rollup_dir the
+# usage rollups are updated for the partitions they touched.
+# Time_Slice is written as YYYY-MM-DD and parsed with that fixed format. Older master files saved as DD/MM/YYYY
+# (e.g. by Excel) are still read, with their own fixed format.
 
 import pandas as pd
 import os
+import json
+import click
 from datetime import datetime
+from UsageStore_ArcGISServer import write_usage, DATE_FORMAT  # custom script
+from UsageRollup_ArcGISServer import update_rollups  # custom script
+import Instrument_ArcGISServer  # custom script
+
+LEGACY_DATE_FORMATS = ['%d/%m/%Y', '%Y-%m-%d %H:%M:%S']  # formats older master files were saved with
+
+# Parse Time_Slice with the fixed DATE_FORMAT, only values that don't match are tried against the legacy formats
+def parse_time_slices(time_slices):
+    parsed = pd.to_datetime(time_slices, format=DATE_FORMAT, errors='coerce')
+    for date_format in LEGACY_DATE_FORMATS:
+        unparsed = parsed.isna() & time_slices.notna()
+        if not unparsed.any():
+            break
+        parsed[unparsed] = pd.to_datetime(time_slices[unparsed], format=date_format, errors='coerce')
+
+    unparsed = parsed.isna() & time_slices.notna()
+    if unparsed.any():
+        raise ValueError(f"Unrecognised Time_Slice values: {list(time_slices[unparsed].unique()[:5])}")
+    return parsed
+
+# Read the high-water mark Time_Slice for the master file, falls back to scanning the Time_Slice column
+def read_high_water_mark(master_path):
+    try:
+        with open(f"{master_path}.hwm", 'r') as hwm_file:
+            return pd.Timestamp(json.load(hwm_file)['Time_Slice'])
+    except (OSError, ValueError, KeyError):
+        time_slices = pd.read_csv(master_path, usecols=['Time_Slice'], dtype=str)['Time_Slice']
+        return parse_time_slices(time_slices).max()
+
+# Save the high-water mark Time_Slice for the master file
+def write_high_water_mark(master_path, time_slice):
+    with open(f"{master_path}.hwm", 'w') as hwm_file:
+        json.dump({'Time_Slice': time_slice.strftime(DATE_FORMAT)}, hwm_file)
 
-type = 'map'
-new_path = r"...csv"
-
-if type == 'map':
-    master_path = r"...csv"
-elif type == 'image':
-    master_path = r"...csv"
-else:
-    raise ValueError("Invalid type! Only 'map' or 'image' are allowed.")
-
-archive = r"..."
-
-# Load data
-master_df = pd.read_csv(master_path)
-new_df = pd.read_csv(new_path)
-
-# Timestamp for archiving the master file
-file_name = os.path.splitext(os.path.split(master_path)[1])[0]
-timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-archived_file = os.path.join(archive, f"{file_name}_{timestamp}.csv")
-
-# Save a copy of the original master file to the archive folder
-master_df.to_csv(archived_file, index=False)
-print(f"\nA copy of the original master file has been archived at '{archived_file}'")
-
-# Ensure the 'Time_Slice' column is in datetime format
-master_df['Time_Slice'] = pd.to_datetime(master_df['Time_Slice'], dayfirst=True, format='mixed')
-new_df['Time_Slice'] = pd.to_datetime(new_df['Time_Slice'], dayfirst=True, format='mixed')
-
-# Find the most recent date in the master DataFrame
-most_recent_date = master_df['Time_Slice'].max()
-print(f"\nMost recent date in the master file: {most_recent_date}")
+# Remove rows where 'Request_Count' is 0 or NaN
+def drop_empty_counts(df):
+    return df[(df['Request_Count'] != 0) & (df['Request_Count'].notna())]
 
-# Filter the new DataFrame for rows that occur after the most recent date
-new_rows = new_df[new_df['Time_Slice'] > most_recent_date]
+# Archive, merge and rewrite the whole master file
+def full_merge(master_path, new_path, archive):
+    # Load data
+    master_df = pd.read_csv(master_path, dtype={'Time_Slice': str})
+    new_df = pd.read_csv(new_path, dtype={'Time_Slice': str})
+
+    # Timestamp for archiving the master file
+    file_name = os.path.splitext(os.path.split(master_path)[1])[0]
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    archived_file = os.path.join(archive, f"{file_name}_{timestamp}.csv")
 
-# List the new dates being added
-new_dates = new_rows['Time_Slice'].unique()
-print(f"\nNew dates being added: {new_dates}")
+    # Save a copy of the original master file to the archive folder
+    master_df.to_csv(archived_file, index=False)
+    print(f"\nA copy of the original master file has been archived at '{archived_file}'")
+
+    # Ensure the 'Time_Slice' column is in datetime format
+    master_df['Time_Slice'] = parse_time_slices(master_df['Time_Slice'])
+    new_df['Time_Slice'] = parse_time_slices(new_df['Time_Slice'])
+
+    # Find the most recent date in the master DataFrame
+    most_recent_date = master_df['Time_Slice'].max()
+    print(f"\nMost recent date in the master file: {most_recent_date}")
+
+    # Filter the new DataFrame for rows that occur after the most recent date
+    new_rows = new_df[new_df['Time_Slice'] > most_recent_date]
+
+    # List the new dates being added
+    new_dates = new_rows['Time_Slice'].unique()
+    print(f"\nNew dates being added: {new_dates}")
+
+    print(f"\nNumber of new rows to be added: {len(new_rows)}")
+
+    # Append the new rows to the master DataFrame
+    updated_master_df = pd.concat([master_df, new_rows], ignore_index=True)
+
+    # Print message before removing rows with zero or NaN 'Request_Count'
+    print(f"\nRemoving rows where 'Request_Count' is 0 or NaN...")
+
+    updated_master_df_cleaned = drop_empty_counts(updated_master_df)
+
+    # Save the cleaned DataFrame to a new CSV
+    updated_master_df_cleaned.to_csv(master_path, index=False, date_format=DATE_FORMAT)
+    write_high_water_mark(master_path, updated_master_df_cleaned['Time_Slice'].max())
+    print(f"\nNew rows have been appended, cleaned, and saved to '{master_path}'\n")
+
+    return drop_empty_counts(new_rows)
+
+# Append only the cleaned rows after the high-water mark to the master file
+def incremental_merge(master_path, new_path, archive):
+    most_recent_date = read_high_water_mark(master_path)
+    print(f"\nMost recent date in the master file: {most_recent_date}")
+
+    new_df = pd.read_csv(new_path, dtype={'Time_Slice': str})
+    new_df['Time_Slice'] = parse_time_slices(new_df['Time_Slice'])
+
+    # Filter the new DataFrame for rows that occur after the most recent date, without zero or NaN 'Request_Count'
+    new_rows = drop_empty_counts(new_df[new_df['Time_Slice'] > most_recent_date])
+
+    if new_rows.empty:
+        print("\nNo new rows to add, the master file is unchanged.\n")
+        return new_rows
+
+    # List the new dates being added
+    new_dates = new_rows['Time_Slice'].unique()
+    print(f"\nNew dates being added: {new_dates}")
+
+    print(f"\nNumber of new rows to be added: {len(new_rows)}")
+
+    # Match the column order of the master file and its date format
+    master_columns = pd.read_csv(master_path, nrows=0).columns
+    new_rows = new_rows.reindex(columns=master_columns)
+    latest_date = new_rows['Time_Slice'].max()
+    new_rows['Time_Slice'] = new_rows['Time_Slice'].dt.strftime(DATE_FORMAT)
+
+    # Archive the appended rows as a delta file instead of a full copy of the master file
+    file_name = os.path.splitext(os.path.split(master_path)[1])[0]
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    delta_file = os.path.join(archive, f"{file_name}_{timestamp}_delta.csv")
+    new_rows.to_csv(delta_file, index=False)
+    print(f"\nThe appended rows have been archived at '{delta_file}'")
+
+    new_rows.to_csv(master_path, mode='a', header=False, index=False)
+    write_high_water_mark(master_path, latest_date)
+    print(f"\nNew rows have been cleaned and appended to '{master_path}'\n")
+
+    return new_rows
+
+# CLICK cmds
+@click.command()
+@Instrument_ArcGISServer.instrumented
+@click.option('--new_path', type=click.Path(exists=True), default=None, help='Path to the new usage report CSV.')
+@click.option('--server_type', type=click.Choice(['map', 'image']), default='map', help='Choose between the ArcGIS or ArcGIS ImageServer master file.')
+@click.option('--master_path', type=click.Path(exists=True), default=None, help='Path to the master CSV. Overrides the default for the server type.')
+@click.option('--archive', type=click.Path(exists=True), default=None, help='Archive directory for copies of the master file.')
+@click.option('--incremental', is_flag=True, default=False, help='Only append the new rows after the high-water mark instead of rewriting the master file.')
+@click.option('--parquet_dir', type=click.Path(), default=None, help='Also merge the new rows into the partitioned Parquet usage store in this directory.')
+@click.option('--rollup_dir', type=click.Path(), default=None, help='Also update the usage rollups in this directory. Requires --parquet_dir.')
+
+def main(new_path, server_type, master_path, archive, incremental, parquet_dir, rollup_dir):
+    default_new = r"...csv"
+    new_path = new_path if new_path else default_new
+
+    if server_type == 'map':
+        default_master = r"...csv"
+    else:
+        default_master = r"...csv"
+    master_path = master_path if master_path else default_master
+
+    default_archive = r"..."
+    archive = archive if archive else default_archive
 
-print(f"\nNumber of new rows to be added: {len(new_rows)}")
+    with Instrument_ArcGISServer.span('merge', master_path, incremental=incremental):
+        if incremental:
+            new_rows = incremental_merge(master_path, new_path, archive)
+        else:
+            new_rows = full_merge(master_path, new_path, archive)
 
-# Append the new rows to the master DataFrame
-updated_master_df = pd.concat([master_df, new_rows], ignore_index=True)
+    if parquet_dir and not new_rows.empty:
+        with Instrument_ArcGISServer.span('output', parquet_dir, rows=len(new_rows)):
+            partitions = write_usage(new_rows, parquet_dir)
 
-# Print message before removing rows with zero or NaN 'Request_Count'
-print(f"\nRemoving rows where 'Request_Count' is 0 or NaN...")
+        if rollup_dir:
+            with Instrument_ArcGISServer.span('rollup', rollup_dir, partitions=len(partitions)):
+                update_rollups(parquet_dir, rollup_dir, partitions)
 
-# Remove rows where 'Request_Count' is 0 or NaN
-updated_master_df_cleaned = updated_master_df[
-    (updated_master_df['Request_Count'] != 0) & 
-    (updated_master_df['Request_Count'].notna())
-]
-
-# Save the cleaned DataFrame to a new CSV
-updated_master_df_cleaned.to_csv(master_path, index=False)
-print(f"\nNew rows have been appended, cleaned, and saved to '{master_path}'\n")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
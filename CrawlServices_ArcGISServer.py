@@ -0,0 +1,337 @@
+'''
+This script is the shared crawler for the ArcGIS Server inventory scripts. It walks the service directories of a site
+and runs a per-service function over every service using a bounded thread pool, so a full inventory is limited by
+server capacity rather than by round trip latency. Results are handed back in the same order as the directory listing.
+Use with conjunction in other scripts.
+
+The number of concurrent requests per site defaults to DEFAULT_MAX_WORKERS and can be set for each site with a
+"max_workers" entry in arcgis_servers.json. Sites are independent, so run_sites crawls up to DEFAULT_MAX_SITES of them
+at the same time and hands their results back in config order.
+
+With an AdaptiveLimiter (see site_limiter) the concurrency for a site isn't fixed. The crawl starts at the site's
+"min_workers" floor and the limiter adjusts it AIMD-style from the latency and failures of the finished requests: one
+more concurrent request after each window that looks healthy, half as many when the median latency climbs well above
+the site's baseline or too many requests fail, never going outside the min_workers/max_workers range. That way a site
+is crawled as fast as it keeps up with and a busy site is backed off from without tuning max_workers by hand.
+
+list_services_report is a bulk alternative to listing through the arcgis Server object. It reads each folder from the
+admin services report endpoint, one request per folder instead of one or more per service, and hands back light
+service handles with the same .url and .properties attributes.
+
+Each site, folder listing, service and batch is timed as a span in Instrument_ArcGISServer.py.
+
+Requirements: Python 3+, Admin account for Arcgis Server
+'''
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import Transport_ArcGISServer  # custom script
+import Instrument_ArcGISServer  # custom script
+
+DIR_IGNORE = ['System', 'Utilities', r'/']
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MIN_WORKERS = 1
+DEFAULT_MAX_SITES = 4
+REPORT_PARAMETERS = ['description', 'status', 'iteminfo', 'properties', 'extensions']
+
+# Adaptive limiter settings
+LIMITER_MIN_WINDOW = 8  # finished requests before the limit is adjusted, the window is at least the current limit
+LIMITER_LATENCY_TOLERANCE = 2.0  # back off when the median latency is more than this times the baseline
+LIMITER_ERROR_RATE = 0.05  # back off when more than this share of the requests in a window failed
+LIMITER_DECREASE = 0.5  # the limit is multiplied by this when backing off
+
+# Service properties from an admin report, readable as attributes like the arcgis PropertyMap
+class ReportProperties(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+# Light service handle built from an admin report, with the .url and .properties used by the crawl functions
+class ReportService:
+    def __init__(self, url, properties):
+        self.url = url
+        self.properties = ReportProperties(properties)
+
+# Concurrency limit that adapts to how a site is coping, additive increase and multiplicative decrease between
+# min_workers and max_workers. Every request to the site is run in a slot().
+class AdaptiveLimiter:
+    def __init__(self, min_workers=DEFAULT_MIN_WORKERS, max_workers=DEFAULT_MAX_WORKERS, name=''):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.name = name
+        self.limit = self.min_workers
+        self.baseline = None  # lowest median latency of a window
+        self._cond = threading.Condition()
+        self._active = 0
+        self._generation = 0  # bumped when backing off, requests started before that aren't counted
+        self._latencies = []
+        self._failures = 0
+
+    # Wait for a free slot, returns the generation to pass to release
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+            return self._generation
+
+    # Take a slot without waiting, returns the generation or None when they are all in use
+    def try_acquire(self):
+        with self._cond:
+            if self._active >= self.limit:
+                return None
+            self._active += 1
+            return self._generation
+
+    # Start the latency baseline again, for requests that take a different time to the ones before (the limit is kept)
+    def reset_baseline(self):
+        with self._cond:
+            self.baseline = None
+            self._latencies = []
+            self._failures = 0
+            self._generation += 1
+
+    # Finish a request, the limit is adjusted at the end of each window
+    def release(self, generation, seconds, failed=False):
+        with self._cond:
+            self._active -= 1
+            # Requests started at the old limit would make the site look busy for another window
+            if generation == self._generation:
+                self._latencies.append(seconds)
+                self._failures += 1 if failed else 0
+                if len(self._latencies) >= max(self.limit, LIMITER_MIN_WINDOW):
+                    self._adjust()
+            self._cond.notify_all()
+
+    # Called with the lock held
+    def _adjust(self):
+        median = statistics.median(self._latencies)
+        error_rate = self._failures / len(self._latencies)
+        self._latencies = []
+        self._failures = 0
+
+        baseline = median if self.baseline is None else self.baseline
+        slow = median > baseline * LIMITER_LATENCY_TOLERANCE
+        if slow and self.limit == self.min_workers:
+            # Still slow at the floor, so it isn't down to the crawl. The site is just slower now (or the baseline came
+            # from a window of unusually quick services), start again from this window.
+            baseline = median
+            slow = False
+        self.baseline = min(baseline, median)
+
+        if error_rate > LIMITER_ERROR_RATE or slow:
+            limit = max(self.min_workers, int(self.limit * LIMITER_DECREASE))
+            if limit < self.limit:
+                print(f"{self.name}: backing off to {limit} concurrent requests "
+                      f"(median {median:.3f}s against {baseline:.3f}s, {error_rate:.0%} failed)")
+                self._generation += 1
+            self.limit = limit
+        else:
+            self.limit = min(self.max_workers, self.limit + 1)
+
+    # Run a request in a slot, its latency is timed and an exception counts as a failure
+    @contextlib.contextmanager
+    def slot(self):
+        generation = self.acquire()
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.release(generation, time.perf_counter() - start, failed)
+
+# Run a request in a slot of the limiter, or straight away when there isn't one
+def limited(limiter):
+    return limiter.slot() if limiter else contextlib.nullcontext()
+
+# Raised by a crawl function that only finished part of a service (e.g. one of several collectors failed). The service
+# counts as failed for the limiter and the failures, but its partial result is still yielded.
+class PartialResult(Exception):
+    def __init__(self, result, message):
+        super().__init__(message)
+        self.result = result
+
+# Count of the services (and directories) a crawl couldn't finish, so a site with gaps isn't taken as complete
+class CrawlFailures:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, count=1):
+        with self._lock:
+            self.count += count
+
+# Add to the failures of a crawl when the caller is counting them
+def add_failures(failures, count=1):
+    if failures is not None and count > 0:
+        failures.add(count)
+
+# Get the concurrency limit for a site from its arcgis_servers.json entry
+def site_max_workers(server_info, max_workers=None):
+    if max_workers:
+        return max_workers
+    return int(server_info.get('max_workers', DEFAULT_MAX_WORKERS))
+
+# Get the adaptive limiter for a site, between the "min_workers" and "max_workers" in its arcgis_servers.json entry.
+# A max_workers override (e.g. --max_workers) is the ceiling.
+def site_limiter(site, server_info, max_workers=None):
+    ceiling = site_max_workers(server_info, max_workers)
+    floor = min(int(server_info.get('min_workers', DEFAULT_MIN_WORKERS)), ceiling)
+    return AdaptiveLimiter(floor, ceiling, name=site)
+
+# List (directory, service) pairs for a server, the directories are listed in parallel
+def list_services(server, max_workers=DEFAULT_MAX_WORKERS, dir_ignore=DIR_IGNORE, limiter=None, failures=None):
+    directories = [dir for dir in server.services.folders if dir not in dir_ignore]
+
+    def list_directory(dir):
+        try:
+            with limited(limiter), Instrument_ArcGISServer.span('folder', dir):
+                return [(dir, service) for service in server.services.list(folder=dir)]
+        except Exception as e:
+            print(f"Failed to list services in directory '{dir}': {e}")
+            add_failures(failures)
+            return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = list(executor.map(list_directory, directories))
+
+    return [pair for listing in listings for pair in listing]
+
+# Build a service handle from its entry in a folder report. Reports without the extensions fall back to
+# one request for the full service JSON.
+def report_service(folder_url, token, report):
+    service_url = f"{folder_url}/{report['serviceName']}.{report['type']}"
+    if 'extensions' not in report:
+        response = Transport_ArcGISServer.get(service_url, params={'f': 'json', 'token': token})
+        response.raise_for_status()
+        return ReportService(service_url, response.json())
+
+    properties = dict(report.get('properties') or {})
+    properties.update({
+        'serviceName': report['serviceName'],
+        'type': report['type'],
+        'description': report.get('description'),
+        'private': report.get('isPrivate', False),
+        'extensions': report['extensions'],
+        'iteminfo': report.get('iteminfo'),
+    })
+    return ReportService(service_url, properties)
+
+# List (directory, service) pairs for a site from the admin services report, one request per directory
+def list_services_report(admin_url, token, max_workers=DEFAULT_MAX_WORKERS, dir_ignore=DIR_IGNORE, limiter=None, failures=None):
+    response = Transport_ArcGISServer.get(f"{admin_url}/services", params={'f': 'json', 'token': token})
+    response.raise_for_status()
+    directories = [dir for dir in response.json().get('folders', []) if dir not in dir_ignore]
+
+    def list_directory(dir):
+        folder_url = f"{admin_url}/services/{dir}"
+        try:
+            with limited(limiter), Instrument_ArcGISServer.span('folder', dir):
+                response = Transport_ArcGISServer.get(f"{folder_url}/report", params={
+                    'f': 'json',
+                    'token': token,
+                    'parameters': json.dumps(REPORT_PARAMETERS)
+                })
+                response.raise_for_status()
+                return [(dir, report_service(folder_url, token, report)) for report in response.json()['reports']]
+        except Exception as e:
+            print(f"Failed to list services in directory '{dir}': {e}")
+            add_failures(failures)
+            return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = list(executor.map(list_directory, directories))
+
+    return [pair for listing in listings for pair in listing]
+
+# Run func(dir, service) for every service on a server and yield the results in listing order.
+# A failing service is reported and skipped, as are services where func returns None. Pass a CrawlFailures to count
+# the services (and directories) that failed.
+# Pass services to crawl an existing listing (e.g. from list_services_report) instead of listing the server.
+# With a limiter the services are run in its slots, up to its max_workers at a time.
+def crawl_services(server, func, max_workers=DEFAULT_MAX_WORKERS, dir_ignore=DIR_IGNORE, services=None, limiter=None, failures=None):
+    max_workers = limiter.max_workers if limiter else max_workers
+    if services is None:
+        services = list_services(server, max_workers, dir_ignore, limiter, failures)
+
+    def process_service(pair):
+        dir, service = pair
+        try:
+            with limited(limiter), Instrument_ArcGISServer.span('service', service.url, folder=dir):
+                return func(dir, service)
+        except PartialResult as e:
+            print(f"Error processing service '{service.url}': {e}")
+            add_failures(failures)
+            return e.result
+        except Exception as e:
+            print(f"Error processing service '{service.url}': {e}")
+            add_failures(failures)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(process_service, services):
+            if result is not None:
+                yield result
+
+# Split the services on a server into batches of batch_size and run func(batch) for each batch, where a batch is a
+# list of (dir, service) pairs and func returns a list of results, one per service. The results are yielded in listing
+# order. Services without a result are counted in failures.
+def crawl_service_batches(server, func, batch_size, max_workers=DEFAULT_MAX_WORKERS, dir_ignore=DIR_IGNORE, limiter=None, failures=None):
+    max_workers = limiter.max_workers if limiter else max_workers
+    services = list_services(server, max_workers, dir_ignore, limiter, failures)
+    batches = [services[i:i + batch_size] for i in range(0, len(services), batch_size)]
+
+    def process_batch(batch):
+        try:
+            with limited(limiter), Instrument_ArcGISServer.span('batch', batch[0][1].url, services=len(batch)):
+                results = func(batch)
+        except Exception as e:
+            print(f"Error processing a batch of {len(batch)} services: {e}")
+            results = []
+        add_failures(failures, len(batch) - len(results))
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for results in executor.map(process_batch, batches):
+            yield from results
+
+# Run func(site, server_info) for each site in arcgis_servers.json in parallel and return (site, result) pairs in
+# config order. A site that fails is reported and gets a None result without stopping the other sites.
+def run_sites(servers, func, max_sites=DEFAULT_MAX_SITES):
+    def run_site(item):
+        site, server_info = item
+        try:
+            with Instrument_ArcGISServer.span('site', site):
+                return site, func(site, server_info)
+        except Exception as e:
+            print(f"\nFailed to process site '{site}': {e}")
+            return site, None
+
+    with ThreadPoolExecutor(max_workers=max_sites) as executor:
+        return list(executor.map(run_site, servers.items()))
+
+# Merge per-site CSV part files into one output in the order given, keeping only the first header.
+# Returns the number of part files merged, the part files are removed.
+def merge_part_files(part_files, outfile):
+    part_files = [part_file for part_file in part_files if part_file and os.path.exists(part_file)]
+    if not part_files:
+        return 0
+
+    with open(outfile, 'w', newline='', encoding='utf-8') as out:
+        for index, part_file in enumerate(part_files):
+            with open(part_file, 'r', newline='', encoding='utf-8') as part:
+                header = part.readline()
+                if index == 0:
+                    out.write(header)
+                shutil.copyfileobj(part, out)
+            os.remove(part_file)
+
+    return len(part_files)
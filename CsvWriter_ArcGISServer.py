@@ -0,0 +1,90 @@
+'''
+This script is the streaming CSV writer for the inventory outputs. Rows are written in chunks as services finish rather
+than collected into one big DataFrame first, the columns come from a declared schema so the column order is fixed,
+and list columns such as the usage Time_Slice and Request_Count are expanded into one row per item on the fly
+(like DataFrame.explode), so memory stays at one chunk however many services and time slices there are.
+Use with conjunction in other scripts.
+
+The output matches DataFrame.to_csv(index=False): missing values and NaN are written as empty fields. Typed values
+(e.g. epoch-ms time slices) can be given a fixed text format at the CSV boundary with a formatter for their column.
+
+Requirements: Python 3+
+'''
+import csv
+import math
+import os
+
+CHUNK_SIZE = 5000  # rows held before they are written
+
+# Format a single value the way pandas writes it
+def format_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    return value
+
+def is_list_like(value):
+    return isinstance(value, (list, tuple)) or (hasattr(value, '__len__') and hasattr(value, '__iter__') and not isinstance(value, (str, bytes, dict)))
+
+class CsvWriter:
+    # explode is a list of columns holding list-likes of the same length, each item gets its own row.
+    # formatters maps a column to a function applied to its value (the whole list for an explode column) when written.
+    def __init__(self, path, columns, explode=(), chunk_size=CHUNK_SIZE, append=False, formatters=None):
+        self.path = path
+        self.columns = list(columns)
+        self.explode = [column for column in self.columns if column in explode]
+        self.formatters = [(index, formatters[column]) for index, column in enumerate(self.columns) if column in (formatters or {})]
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+        self._chunk = []
+
+        write_header = not (append and os.path.exists(path) and os.path.getsize(path))
+        self._file = open(path, 'a' if append else 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file, lineterminator=os.linesep)
+        if write_header:
+            self._writer.writerow(self.columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Add a row (a dict keyed by column), the list columns are expanded into one row per item
+    def write(self, row):
+        values = [row.get(column) for column in self.columns]
+        for index, formatter in self.formatters:
+            if values[index] is not None:
+                values[index] = formatter(values[index])
+        lists = [index for index, column in enumerate(self.columns) if column in self.explode and is_list_like(values[index])]
+
+        if not lists:
+            rows = [values]
+        elif not len(values[lists[0]]):
+            # An empty list gives a single row with the list columns left empty, as with explode
+            rows = [[None if index in lists else value for index, value in enumerate(values)]]
+        else:
+            rows = []
+            for items in zip(*(values[index] for index in lists)):
+                exploded = list(values)
+                for index, item in zip(lists, items):
+                    exploded[index] = item
+                rows.append(exploded)
+
+        self._chunk.extend([format_value(value) for value in row_values] for row_values in rows)
+
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        self._writer.writerows(self._chunk)
+        self.rows_written += len(self._chunk)
+        self._chunk = []
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
@@ -0,0 +1,275 @@
+'''
+This script is the datasource index for "who uses this dataset" lookups. It keeps the XML manifest rows (dataset paths
+per service) and the Portal/AGOL item data URLs in an indexed SQLite database, so the chain
+
+    dataset path -> services -> web map items,    service URL -> web map items
+
+is answered with indexed lookups instead of joining the CSVs by hand. Service URLs are matched on a normalised key
+(lower case, no scheme, no layer index or query string, FeatureServer as MapServer), so a web map layer URL finds the
+service it points at.
+
+The index is filled while GetManifestXML_ArcGISServer.py and GetDataSourcesFromItems_PortalAGOL.py run with
+--index_db, or from their CSV outputs with this script. Once a site has been crawled without failures, or every item of
+the scanned types has been scanned, the rows of services and items that weren't seen (deleted or unpublished since) are
+removed. Can also be run in cmd line with the following:
+
+    DatasourceIndex_ArcGISServer.py --index_db "C:\...\datasources.db" --manifest_csv "C:\...\ServicesManifest_XML_....csv" --items_csv "C:\...\WebMaps_....csv"
+    DatasourceIndex_ArcGISServer.py --index_db "C:\...\datasources.db" --dataset "Roads_FC"
+    DatasourceIndex_ArcGISServer.py --index_db "C:\...\datasources.db" --dataset "\\gisdata\sde\roads.sde"
+    DatasourceIndex_ArcGISServer.py --index_db "C:\...\datasources.db" --service "https://gis.../arcgis/rest/services/Folder/Roads/MapServer"
+    DatasourceIndex_ArcGISServer.py --index_db "C:\...\datasources.db" --server "gis.host.com"
+
+Requirements: Python 3+, pandas
+'''
+import re
+import sqlite3
+import threading
+import time
+import click
+import pandas as pd
+import Instrument_ArcGISServer  # custom script
+
+CSV_CHUNK_SIZE = 50000  # rows read from a CSV at a time
+
+# Everything up to and including the service type, e.g. host/arcgis/rest/services/Folder/Roads/MapServer
+SERVICE_URL = re.compile(
+    r'^(?:[a-z]+://)?(.+?/rest/services/.+?/(?:MapServer|FeatureServer|ImageServer|GPServer|GeocodeServer|'
+    r'GeometryServer|NAServer|SceneServer|StreamServer|VectorTileServer|GlobeServer))(?:[/?#].*)?$',
+    re.IGNORECASE
+)
+
+# Normalised key for a service URL, None when the URL isn't an ArcGIS Server service
+def service_key(url):
+    if not isinstance(url, str):
+        return None
+    match = SERVICE_URL.match(url.strip())
+    if not match:
+        return None
+    key = re.sub(r'/{2,}', '/', match.group(1)).lower()
+    # A feature service is published with its map service and has the same datasets, so both share the map service key
+    return re.sub(r'/featureserver$', '/mapserver', key)
+
+# Normalised start of the service keys on a server, e.g. gis.host.com/arcgis for https://gis.host.com/arcgis/
+def server_prefix(url):
+    return re.sub(r'/{2,}', '/', re.sub(r'^[a-z]+://', '', url.strip().lower())).rstrip('/')
+
+def like_prefix(prefix):
+    return re.sub(r'([!%_])', r'!\1', prefix) + '%'
+
+class DatasourceIndex:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._replaced = set()  # services and items already replaced in this session
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS service_datasets (
+                service_key TEXT NOT NULL,
+                service_url TEXT NOT NULL,
+                endpoint TEXT,
+                service_dir TEXT,
+                service_name TEXT,
+                service_type TEXT,
+                dataset_name TEXT COLLATE NOCASE,
+                dataset_type TEXT,
+                dataset_path TEXT COLLATE NOCASE,
+                dataset_part1 TEXT COLLATE NOCASE,
+                dataset_part2 TEXT COLLATE NOCASE,
+                resource_path TEXT
+            );
+            CREATE INDEX IF NOT EXISTS service_datasets_service ON service_datasets (service_key);
+            CREATE INDEX IF NOT EXISTS service_datasets_path ON service_datasets (dataset_path);
+            CREATE INDEX IF NOT EXISTS service_datasets_name ON service_datasets (dataset_name);
+            CREATE INDEX IF NOT EXISTS service_datasets_part2 ON service_datasets (dataset_part2);
+
+            CREATE TABLE IF NOT EXISTS item_urls (
+                item_id TEXT NOT NULL,
+                title TEXT,
+                type TEXT,
+                owner TEXT,
+                item_url TEXT,
+                data_url TEXT,
+                service_key TEXT
+            );
+            CREATE INDEX IF NOT EXISTS item_urls_service ON item_urls (service_key);
+            CREATE INDEX IF NOT EXISTS item_urls_item ON item_urls (item_id);
+        ''')
+        self._conn.commit()
+
+    # Replace the rows for keys not yet replaced in this session, so a rerun doesn't duplicate them
+    def _replace(self, table, column, keys):
+        new_keys = [key for key in dict.fromkeys(keys) if (table, key) not in self._replaced]
+        self._conn.executemany(f'DELETE FROM {table} WHERE {column} = ?', [(key,) for key in new_keys])
+        self._replaced.update((table, key) for key in new_keys)
+
+    # Add the manifest rows from GetManifestXML_ArcGISServer.parse_xml_to_df (or its CSV)
+    def add_manifest_rows(self, df):
+        df = df.fillna("N/A")
+        keys = [service_key(url) or url for url in df['Service_URL']]
+        rows = [
+            (key, row.Service_URL, row.Endpoint, row.ServiceDir, row.ServiceName, row.ServiceType, row.DatasetName,
+             row.DatasetType, row.DatasetPath, row.DatasetPart1, row.DatasetPart2, row.ResourcePath)
+            for key, row in zip(keys, df.itertuples(index=False))
+        ]
+        with self._lock:
+            self._replace('service_datasets', 'service_key', keys)
+            self._conn.executemany('INSERT INTO service_datasets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+
+    # Add items from GetDataSourcesFromItems_PortalAGOL.extract_relevant_info, data_urls can be a list or one URL per row
+    def add_items(self, items):
+        rows = []
+        for item in items:
+            data_urls = item.get('data_urls')
+            if not isinstance(data_urls, (list, tuple)):
+                data_urls = [data_urls] if isinstance(data_urls, str) else []
+            for data_url in data_urls:
+                rows.append((item['id'], item.get('title'), item.get('type'), item.get('owner'), item.get('item_url'),
+                             data_url, service_key(data_url)))
+        with self._lock:
+            self._replace('item_urls', 'item_id', [item['id'] for item in items])
+            self._conn.executemany('INSERT INTO item_urls VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+
+    # Delete the rows of the services under a URL (e.g. a site's rest/services URL) that weren't added in this session,
+    # only call it once the whole site has been crawled. Returns the number of services removed.
+    def purge_services(self, url):
+        with self._lock:
+            keys = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT service_key FROM service_datasets WHERE service_key LIKE ? ESCAPE '!'",
+                (like_prefix(server_prefix(url) + '/'),)
+            )]
+            stale = [key for key in keys if ('service_datasets', key) not in self._replaced]
+            self._conn.executemany('DELETE FROM service_datasets WHERE service_key = ?', [(key,) for key in stale])
+            self._conn.commit()
+        return len(stale)
+
+    # Delete the rows of the items of these types that weren't added in this session, only call it once every item of
+    # the types has been scanned. Returns the number of items removed.
+    def purge_items(self, item_types):
+        item_types = {item_type.casefold() for item_type in item_types}
+        with self._lock:
+            rows = self._conn.execute('SELECT DISTINCT item_id, type FROM item_urls').fetchall()
+            stale = list(dict.fromkeys(
+                item_id for item_id, item_type in rows
+                if (item_type or '').casefold() in item_types and ('item_urls', item_id) not in self._replaced
+            ))
+            self._conn.executemany('DELETE FROM item_urls WHERE item_id = ?', [(item_id,) for item_id in stale])
+            self._conn.commit()
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM service_datasets')
+            self._conn.execute('DELETE FROM item_urls')
+            self._conn.commit()
+            self._replaced.clear()
+
+    def _query(self, sql, params):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    # Find the services using a dataset, by its path (or the start of it) or by its name
+    def find_dataset(self, dataset):
+        if '\\' in dataset or '/' in dataset:
+            return self._query(
+                "SELECT * FROM service_datasets WHERE dataset_path = ? OR dataset_path LIKE ? ESCAPE '!' ORDER BY service_key",
+                (dataset, like_prefix(dataset))
+            )
+        return self._query(
+            'SELECT * FROM service_datasets WHERE dataset_name = ? OR dataset_part2 = ? ORDER BY service_key',
+            (dataset, dataset)
+        )
+
+    # Find the items using any of the services
+    def find_items(self, service_keys):
+        service_keys = list(dict.fromkeys(key for key in service_keys if key))
+        if not service_keys:
+            return []
+        placeholders = ', '.join('?' * len(service_keys))
+        return self._query(
+            f'SELECT DISTINCT item_id, title, type, owner, item_url, service_key FROM item_urls WHERE service_key IN ({placeholders}) ORDER BY service_key, title',
+            service_keys
+        )
+
+    # Find the services indexed for a server, e.g. gis.host.com or https://gis.host.com/arcgis
+    def find_server_services(self, server):
+        return self._query(
+            "SELECT service_key FROM service_datasets WHERE service_key LIKE ? ESCAPE '!' "
+            "UNION SELECT service_key FROM item_urls WHERE service_key LIKE ? ESCAPE '!' ORDER BY service_key",
+            (like_prefix(server_prefix(server)),) * 2
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+# Open the index at a path, or return None when no path is given
+def open_index(path):
+    return DatasourceIndex(path) if path else None
+
+# Print query results as aligned columns
+def echo_rows(title, rows, columns):
+    click.echo(f"\n{title} ({len(rows)}):")
+    for row in rows:
+        click.echo('  ' + ' | '.join(str(row[column]) for column in columns))
+
+# CLICK cmds
+@click.command()
+@Instrument_ArcGISServer.instrumented
+@click.option('--index_db', type=click.Path(), default=None, help='SQLite datasource index.')
+@click.option('--manifest_csv', type=click.Path(exists=True), multiple=True, help='XML manifest CSV to index, can be given more than once.')
+@click.option('--items_csv', type=click.Path(exists=True), multiple=True, help='Portal/AGOL items CSV to index, can be given more than once.')
+@click.option('--rebuild', is_flag=True, default=False, help='Clear the index before the CSVs are loaded.')
+@click.option('--dataset', default=None, help='Find the services and items using a dataset, by name or by (the start of) its path.')
+@click.option('--service', default=None, help='Find the items using a service URL.')
+@click.option('--server', default=None, help='Find the services indexed for a server host.')
+
+def main(index_db, manifest_csv, items_csv, rebuild, dataset, service, server):
+    default_db = r"..."
+    index_db = index_db if index_db else default_db
+
+    index = DatasourceIndex(index_db)
+
+    if rebuild:
+        index.clear()
+
+    for path in manifest_csv:
+        with Instrument_ArcGISServer.span('index', path):
+            for chunk in pd.read_csv(path, chunksize=CSV_CHUNK_SIZE, dtype=str):
+                index.add_manifest_rows(chunk)
+        click.echo(f"Indexed manifest: {path}")
+
+    for path in items_csv:
+        with Instrument_ArcGISServer.span('index', path):
+            for chunk in pd.read_csv(path, chunksize=CSV_CHUNK_SIZE, dtype=str):
+                index.add_items(chunk.where(chunk.notna(), None).to_dict('records'))
+        click.echo(f"Indexed items: {path}")
+
+    start = time.perf_counter()
+    if dataset:
+        services = index.find_dataset(dataset)
+        echo_rows(f"Services using '{dataset}'", services, ['service_url', 'dataset_name', 'dataset_path'])
+        items = index.find_items(row['service_key'] for row in services)
+        echo_rows("Items using those services", items, ['item_id', 'title', 'type', 'owner', 'service_key'])
+
+    if service:
+        items = index.find_items([service_key(service) or service.lower()])
+        echo_rows(f"Items using '{service}'", items, ['item_id', 'title', 'type', 'owner'])
+
+    if server:
+        services = index.find_server_services(server)
+        echo_rows(f"Services on '{server}'", services, ['service_key'])
+        items = index.find_items(row['service_key'] for row in services)
+        echo_rows("Items using those services", items, ['item_id', 'title', 'type', 'owner', 'service_key'])
+
+    if dataset or service or server:
+        click.echo(f"\nQuery took {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    index.close()
+
+if __name__ == '__main__':
+    main()
@@ -6,74 +6,169 @@ identify old data sources etc.
 
 Can also be run in cmd line with the following:
 
-    GetItems_PortalAgol.py --site agol --out_dir "C:\directory..." --out_name "Filename.csv"
+    GetItems_PortalAgol.py --site agol --out_dir "C:\directory..." --out_name "Filename.csv" --max_workers 8 --cache_dir "C:\...\item_cache"
 
     note - --site accepts strings "portal" or "agol" only
 
-"""
+The search is paged and each page is written to the CSV as soon as it is processed. Use --item_type (repeatable) to
+choose the item types, defaults to Web Map, and --modified_after YYYY-MM-DD to only scan items changed since a date.
+With --index_db the data URLs are also added to the datasource index (see DatasourceIndex_ArcGISServer.py), and a full
+scan without --modified_after removes the items of the scanned types that are gone from it.
 
-## TODO: add item type paramenter ie webmap, application etc
+"""
 
 import Authenticate_ArcGISServer  # custom script
+import Instrument_ArcGISServer  # custom script
+from DatasourceIndex_ArcGISServer import open_index  # custom script
 import click
 import os
+import glob
+import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import arcpy
 from arcgis.gis import GIS
 import pandas as pd
 import datetime
 
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_PAGE_SIZE = 100  # the most results a content search will return per request
+
+# Build the search query for the item types, optionally limited to items modified between two times (epoch ms)
+def build_query(item_types, modified_start=None, modified_end=None):
+    query = ' OR '.join(f'type:"{item_type}"' for item_type in item_types)
+    if modified_start is not None:
+        query = f'({query}) AND modified:[{modified_start:019d} TO {modified_end:019d}]'
+    return query
+
+# Page through the content search, yielding each page of items as it arrives.
+# Type searches also match similar types (e.g. Web Map matches Web Mapping Application) so those are dropped here.
+# The search ignores case, so the types are compared without case too (e.g. --item_type "web map").
+# The search won't page past 10,000 results, so it is paged by key instead of start offset: the results are sorted by
+# modified date and each page narrows the query to items modified since the last one. The items at that boundary come
+# back on the next page too and are skipped by id. Only items with the same modified date as a whole page are paged
+# by start offset.
+def search_pages(gis, item_types, modified_after=None, page_size=DEFAULT_PAGE_SIZE):
+    wanted_types = {item_type.casefold() for item_type in item_types}
+    modified_start = int(modified_after.timestamp() * 1000) if modified_after else 0
+    modified_end = int(datetime.datetime.now().timestamp() * 1000)  # fixed so items modified during the scan aren't seen twice
+    start = 1
+    boundary_ids = set()  # ids of the items modified at modified_start that were already yielded
+    while True:
+        query = build_query(item_types, modified_start, modified_end)
+        page = gis.content.advanced_search(query=query, max_items=page_size, start=start, sort_field='modified', sort_order='asc')
+        results = [item for item in page['results'] if item.id not in boundary_ids]
+        items = [item for item in results if item.type.casefold() in wanted_types]
+        if items:
+            yield items
+        if not page['results'] or page.get('nextStart', -1) < 0:
+            return
+
+        last_modified = page['results'][-1].modified
+        if last_modified == modified_start:
+            start = page['nextStart']
+            boundary_ids.update(item.id for item in results)
+        else:
+            modified_start = last_modified
+            start = 1
+            boundary_ids = {item.id for item in results if item.modified == last_modified}
+
+# Yield every 'url' value in an item's data, walking the nested dicts and lists with an explicit stack
+# so deeply nested operational layers don't recurse or copy lists. URLs come out in document order.
 def find_urls(data):
-    urls = []
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if key == 'url':
-                urls.append(value)
-            elif isinstance(value, (dict, list)):
-                urls.extend(find_urls(value))
-    elif isinstance(data, list):
-        for item in data:
-            urls.extend(find_urls(item))
-    return urls
-
-def extract_relevant_info(content):
-    item_list = []
-    for item in content:
+    stack = [iter([(None, data)])]
+    while stack:
         try:
-            url_list = []
-
-            # Use function to find all URLs in item.get_data
-            data = item.get_data()
-            urls = find_urls(data)
-
-            # Convert Unix time to 'dd/mm/yyyy' format
-            created_date = datetime.datetime.fromtimestamp(item.created / 1000).strftime('%d/%m/%Y')
-            modified_date = datetime.datetime.fromtimestamp(item.modified / 1000).strftime('%d/%m/%Y')
-
-            # Append all info to a list
-            item_info = {
-                'title': item.title,
-                'id': item.id,
-                'type': item.type,
-                'owner': item.owner,
-                'created': created_date,
-                'modified': modified_date,
-                # 'last_viewed_unix': item.lastViewed, # Added to AGOL Nov 2022 
-                'views': item.numViews,
-                'item_url': item.url,
-                'data_urls': urls
-            }
-            item_list.append(item_info)
-            print(fr'{item} ADDED TO LIST...')
-        except Exception as e:
-            print(f"Error processing item '{item.title}': {str(e)}")
-    return item_list
+            key, value = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+
+        if key == 'url':
+            yield value
+        elif isinstance(value, dict):
+            stack.append(iter(value.items()))
+        elif isinstance(value, list):
+            stack.append((None, item) for item in value)
+
+# Get the data for an item, using the local cache when the item has not been modified since it was cached.
+# A cache file that can't be read (e.g. cut off by a crash) is treated as not cached and written again.
+def get_item_data(item, cache_dir=None):
+    if not cache_dir:
+        return item.get_data()
+
+    cache_file = os.path.join(cache_dir, f"{item.id}_{item.modified}.json")
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable cache file '{cache_file}': {str(e)}")
+
+    data = item.get_data()
+
+    # Replace any cached data from older versions of the item. The data is written to a temporary file first so a
+    # crash part way never leaves a partial cache file behind.
+    for old_file in glob.glob(os.path.join(cache_dir, f"{item.id}_*.json")):
+        os.remove(old_file)
+    with open(f"{cache_file}.tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(f"{cache_file}.tmp", cache_file)
+
+    return data
+
+def get_item_info(item, cache_dir=None):
+    try:
+        # Use function to find all URLs in item.get_data
+        with Instrument_ArcGISServer.span('item', item.id):
+            data = get_item_data(item, cache_dir)
+        urls = list(find_urls(data))
+
+        # Convert Unix time to 'dd/mm/yyyy' format
+        created_date = datetime.datetime.fromtimestamp(item.created / 1000).strftime('%d/%m/%Y')
+        modified_date = datetime.datetime.fromtimestamp(item.modified / 1000).strftime('%d/%m/%Y')
+
+        # Append all info to a list
+        item_info = {
+            'title': item.title,
+            'id': item.id,
+            'type': item.type,
+            'owner': item.owner,
+            'created': created_date,
+            'modified': modified_date,
+            # 'last_viewed_unix': item.lastViewed, # Added to AGOL Nov 2022 
+            'views': item.numViews,
+            'item_url': item.url,
+            'data_urls': urls
+        }
+        print(fr'{item} ADDED TO LIST...')
+        return item_info
+    except Exception as e:
+        print(f"Error processing item '{item.title}': {str(e)}")
+        return None
+
+# Fetch the item data with a bounded pool of workers, the items stay in search order
+def extract_relevant_info(content, max_workers=DEFAULT_MAX_WORKERS, cache_dir=None):
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    item_info = functools.partial(get_item_info, cache_dir=cache_dir)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [info for info in executor.map(item_info, content) if info is not None]
 
 @click.command()
+@Instrument_ArcGISServer.instrumented
 @click.option('--site', required=True, type=str, help='Specify the site: agol or portal.')
 @click.option('--out_dir', type=click.Path(exists=True), default=None, help='Output directory for the CSV file.')
 @click.option('--out_name', default=None, help='Output filename for the CSV file. Please specify extension')
-
-def main(site, out_dir, out_name):
+@click.option('--max_workers', type=int, default=DEFAULT_MAX_WORKERS, help='Number of items to fetch data for at the same time.')
+@click.option('--cache_dir', type=click.Path(), default=None, help='Directory to cache item data in, unchanged items are not downloaded again.')
+@click.option('--item_type', multiple=True, default=['Web Map'], help='Item type to scan, can be given more than once. Defaults to Web Map.')
+@click.option('--modified_after', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='Only scan items modified after this date (YYYY-MM-DD).')
+@click.option('--page_size', type=click.IntRange(1, DEFAULT_PAGE_SIZE), default=DEFAULT_PAGE_SIZE, help='Number of items to request per search page.')
+@click.option('--index_db', type=click.Path(), default=None, help='Also add the data URLs to the SQLite datasource index.')
+
+def main(site, out_dir, out_name, max_workers, cache_dir, item_type, modified_after, page_size, index_db):
     # Determine site URL based on user input
     if site == 'agol':
         site_url = r"..."
@@ -95,21 +190,43 @@ def main(site, out_dir, out_name):
     # Log in to GIS site
     gis = GIS(site_url, username, password, verify_cert=False)
 
-    # Get web maps
-    content = gis.content.search('*', item_type='Web Map', max_items=-1)
-
-    # Extracting relevant information
-    item_list = extract_relevant_info(content)
-
-    # List to pandas df
-    df = pd.DataFrame(item_list)
-    # Explode data URLs
-    df_explode = df.explode('data_urls')
-
-    # Save
     outfile = os.path.join(out_dir, out_name)
-    df_explode.to_csv(outfile, index=False)
-    print(f"\nScript finished. Saved: {outfile}")
+    items_written = 0
+    items_failed = 0
+    index = open_index(index_db)
+
+    # Extract each page of items and append it to the CSV as it arrives
+    for content in search_pages(gis, list(item_type), modified_after, page_size):
+        item_list = extract_relevant_info(content, max_workers, cache_dir)
+        items_failed += len(content) - len(item_list)
+        if not item_list:
+            continue
+
+        with Instrument_ArcGISServer.span('output', outfile, rows=len(item_list)):
+            # List to pandas df
+            df = pd.DataFrame(item_list)
+            # Explode data URLs
+            df_explode = df.explode('data_urls')
+
+            # Save
+            df_explode.to_csv(outfile, mode='w' if items_written == 0 else 'a', header=items_written == 0, index=False)
+            if index:
+                index.add_items(item_list)
+        items_written += len(item_list)
+        print(f"\n{items_written} items saved...")
+
+    if index:
+        # After a full scan without errors, the index rows of items of the scanned types that are gone can be removed
+        if not modified_after and not items_failed:
+            removed = index.purge_items(item_type)
+            if removed:
+                print(f"\nRemoved {removed} item(s) no longer on the site from the datasource index")
+        index.close()
+
+    if items_written:
+        print(f"\nScript finished. Saved: {outfile}")
+    else:
+        print("\nScript finished. No items found, CSV file not saved.")
 
 if __name__ == '__main__':
     main()
@@ -1,35 +1,143 @@
 
 """
-This script gets the manifest.json from ArcGIS Server admin directory and outputs the data to a CSV file.
+This script gets the manifest.json from ArcGIS Server admin directory and outputs the data to CSV files. The manifests
+are normalised into four long tables with fixed columns, joinable on server_name, directory and service_name (and
+database_index for the datasets):
+
+    ..._services.csv     one row per service with its database, dataset and resource counts
+    ..._databases.csv    one row per database (workspace) the service uses
+    ..._datasets.csv     one row per dataset in each database
+    ..._resources.csv    one row per resource (the .mxd/.aprx the service was published from)
 
 To run the script, use the following command format in your terminal or command prompt:
 
-    python GetManifestJson_ArcGISServer.py --gis_sites_json path/to/gis_sites.json --out_dir path/to/output/directory --out_name output_filename.csv --server_name specific_server_name
+    python GetManifestJson_ArcGISServer.py --gis_sites_json path/to/gis_sites.json --out_dir path/to/output/directory --out_name output_filename.csv --server_type map --server_name specific_server_name
 
 Options:
     --gis_sites_json: Path to the JSON file containing GIS site data. (optional, default: ....gis_sites.json)
     --out_dir: Output directory for the CSV file. (optional, default: ...Outputs)
-    --out_name: Output filename for the CSV file. Please specify the extension. (optional, default: ServicesManifest_JSON_YYYYMMDD.csv.csv)
+    --out_name: Output filename for the CSV files, the table name is added to it. Please specify the extension. (optional, default: ServicesManifest_JSON_YYYYMMDD.csv)
+    --server_type: Choose between ArcGIS (map) or ArcGIS ImageServer (image) servers in the config file. (optional, default: map)
     --server_name: The name of the ArcGIS Server to process. If not provided, all servers in the config file will be processed. (optional)
+    --max_workers: Most concurrent requests per server, the crawl adapts between min_workers and this. Overrides max_workers in the config file. (optional, default: 8)
+    --state_db: SQLite state store, only new or changed services are re-fetched. (optional)
+    --max_sites: Number of servers to process at the same time. (optional, default: 4)
 """
 
-## TODO need to explode the dicts for datasets and connection strings for the csv
-## TODO update to use the new gis server json format
-
 import json
 import pandas as pd
 import click
 import os
-from arcgis.gis.server import Server
+import functools
 import Authenticate_ArcGISServer  # custom script
+from CrawlServices_ArcGISServer import crawl_services, run_sites, merge_part_files, site_limiter, DEFAULT_MAX_SITES  # custom script
+from StateStore_ArcGISServer import incremental, open_store  # custom script
+import Instrument_ArcGISServer  # custom script
+
+KEY_COLUMNS = ['server_name', 'directory', 'service_name']
+TABLES = {
+    'services': KEY_COLUMNS + ['database_count', 'dataset_count', 'resource_count'],
+    'databases': KEY_COLUMNS + [
+        'database_index', 'onServerWorkspaceFactoryProgID', 'onServerConnectionString', 'onPremiseConnectionString',
+        'onServerName', 'onPremisePath', 'byReference'
+    ],
+    'datasets': KEY_COLUMNS + ['database_index', 'onServerName'],
+    'resources': KEY_COLUMNS + ['resource_index', 'onPremisePath', 'clientName', 'serverPath'],
+}
+BATCH_SIZE = 1000  # manifests normalised at a time
+
+# Get the manifest.json for a single service
+def get_service_manifest(server_name, dir, service):
+    service_name = service.properties.serviceName
+    print(f"Processing service: {service_name}")
+    manifest = service.iteminformation.manifest
+    manifest['server_name'] = server_name  # Add server_name to manifest
+    manifest['directory'] = dir  # Add service folder
+    manifest['service_name'] = service_name  # Add service_name to manifest
+    return manifest
+
+# Normalise a batch of manifests into the long tables, returns a DataFrame for each table with the TABLES columns
+def normalize_manifests(manifests):
+    manifests = [dict(manifest, databases=manifest.get('databases') or [], resources=manifest.get('resources') or []) for manifest in manifests]
+
+    databases = pd.json_normalize(manifests, record_path='databases', meta=KEY_COLUMNS)
+    databases['database_index'] = [index for manifest in manifests for index in range(len(manifest['databases']))]
+
+    # Explode the datasets of each database and normalise them in one pass
+    if 'datasets' in databases:
+        exploded = databases[KEY_COLUMNS + ['database_index', 'datasets']].explode('datasets').dropna(subset=['datasets']).reset_index(drop=True)
+        datasets = pd.concat([exploded[KEY_COLUMNS + ['database_index']], pd.json_normalize(exploded['datasets'].tolist())], axis=1)
+    else:
+        datasets = pd.DataFrame()
+
+    resources = pd.json_normalize(manifests, record_path='resources', meta=KEY_COLUMNS)
+    resources['resource_index'] = [index for manifest in manifests for index in range(len(manifest['resources']))]
+
+    services = pd.DataFrame(manifests, columns=KEY_COLUMNS)
+    services['database_count'] = [len(manifest['databases']) for manifest in manifests]
+    services['dataset_count'] = [sum(len(database.get('datasets') or []) for database in manifest['databases']) for manifest in manifests]
+    services['resource_count'] = [len(manifest['resources']) for manifest in manifests]
+
+    tables = {'services': services, 'databases': databases, 'datasets': datasets, 'resources': resources}
+    return {table: df.reindex(columns=TABLES[table]) for table, df in tables.items()}
+
+# Output path for a table, e.g. ServicesManifest_JSON_20240101_datasets.csv
+def table_path(outfile, table):
+    root, ext = os.path.splitext(outfile)
+    return f"{root}_{table}{ext or '.csv'}"
+
+# Normalise a batch of manifests and write each table to its CSV, the header is only written with the first batch
+def write_tables(manifests, paths, header):
+    for table, df in normalize_manifests(manifests).items():
+        df.to_csv(paths[table], mode='w' if header else 'a', header=header, index=False)
+
+# Normalises the manifests in batches of BATCH_SIZE as they arrive and writes each table to its own CSV
+class ManifestTablesWriter:
+    def __init__(self, outfile):
+        self.paths = {table: table_path(outfile, table) for table in TABLES}
+        self.manifests_written = 0
+        self._batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, manifest):
+        self._batch.append(manifest)
+        if len(self._batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        write_tables(self._batch, self.paths, header=self.manifests_written == 0)
+        self.manifests_written += len(self._batch)
+        self._batch = []
+
+    # Save the remaining manifests, the tables are written with just their headers when there were none
+    def close(self):
+        if self._batch or not self.manifests_written:
+            self.flush()
+
+# Normalise the manifests in batches as they arrive and write each table to its own CSV, returns the CSV paths
+def write_manifest_tables(manifests, outfile):
+    with ManifestTablesWriter(outfile) as writer:
+        for manifest in manifests:
+            writer.write(manifest)
+    return list(writer.paths.values())
 
 @click.command()
+@Instrument_ArcGISServer.instrumented
 @click.option('--gis_sites_json', type=click.Path(exists=True), default=None, help='Path to the JSON file containing GIS site data.')
 @click.option('--out_dir', type=click.Path(exists=True), default=None, help='Output directory for the CSV file.')
 @click.option('--out_name', default=None, help='Output filename for the CSV file. Please specify extension')
+@click.option('--server_type', type=click.Choice(['map', 'image']), default='map', help='Choose between ArcGIS (map) or ArcGIS ImageServer (image).')
 @click.option('--server_name', default=None, help='The name of the ArcGIS Server to process. If not provided, all servers in the config file will be processed.')
+@click.option('--max_workers', type=int, default=None, help='Most concurrent requests per server, the crawl adapts between min_workers and this. Overrides max_workers in the config file.')
+@click.option('--state_db', type=click.Path(), default=None, help='SQLite state store, only new or changed services are re-fetched.')
+@click.option('--max_sites', type=int, default=DEFAULT_MAX_SITES, help='Number of servers to process at the same time.')
 
-def main(gis_sites_json, out_dir, out_name, server_name):
+def main(gis_sites_json, out_dir, out_name, server_type, server_name, max_workers, state_db, max_sites):
     # Set default paths and filenames
     default_json = r"...arcgis_servers.json"
     gis_sites_json = gis_sites_json if gis_sites_json else default_json
@@ -50,87 +158,70 @@ def main(gis_sites_json, out_dir, out_name, server_name):
         print(f"Failed to load config file '{gis_sites_json}': {e}")
         return
 
-    all_formatted_data = []
+    outfile = os.path.join(out_dir, out_name)
+    store = open_store(state_db)
 
-    # Function to process a single server
-    def process_server(server_url, server_name):
+    # Function to process a single server, its manifests are written to its own part files in batches as they arrive
+    def process_server(server_name, site):
+        print(f"Processing server: {server_name}")
+        server_url = site['admin']
         try:
             # Authenticate and create a Server instance
             username, password = Authenticate_ArcGISServer.get_creds(server_url)
-            server = Server(url=server_url, username=username, password=password)
+            server = Authenticate_ArcGISServer.get_server(server_url, username, password)
             print(f"\nAuthenticated to server '{server_url}' successfully.")
         except Exception as e:
             print(f"\nFailed to authenticate to server '{server_url}': {e}")
-            return
-
-        directories = server.services.folders
-        dir_ignore = ['System', 'Utilities', r'/']
-
-        dict_list = []
+            return None
 
-        # List and process services in other directories
+        # List and process services in other directories, the manifests are fetched concurrently
+        # and unchanged services come from the state store
         print(f"\nIdentifying Services on server '{server_url}':\n")
-        for dir in directories:
-            if dir not in dir_ignore:
-                try:
-                    for service in server.services.list(folder=dir):
-                        service_name = service.properties.serviceName
-                        print(f"Processing service: {service_name}")
-                        manifest = service.iteminformation.manifest
-                        manifest['server_name'] = server_name  # Add server_name to manifest
-                        manifest['directory'] = dir  # Add service folder
-                        manifest['service_name'] = service_name  # Add service_name to manifest
-                        dict_list.append(manifest)
-                except Exception as e:
-                    print(f"Failed to list services in directory '{dir}' on server '{server_url}': {e}")
-
-        # Format data
-        formatted_data = []
-        for data_dict in dict_list:
-            formatted_dict = {}
-            for key, value in data_dict.items():
-                if isinstance(value, list):
-                    for index, item in enumerate(value):
-                        if isinstance(item, dict):  # Check if item is a dictionary
-                            for sub_key, sub_value in item.items():
-                                formatted_dict[f"{key}_{index}_{sub_key}"] = sub_value
-                        else:
-                            formatted_dict[f"{key}_{index}"] = item  # Handle non-dict items in the list
-                else:
-                    formatted_dict[key] = value
-            formatted_data.append(formatted_dict)
-
-        all_formatted_data.extend(formatted_data)
-
-    # Process either a single server or all servers
+        limiter = site_limiter(server_name, site, max_workers)
+        service_manifest = functools.partial(get_service_manifest, server_name)
+        manifests = crawl_services(server, incremental(store, server_url, 'manifest_json', service_manifest), limiter=limiter)
+
+        part_file = f"{outfile}.{server_name}.part"
+        try:
+            write_manifest_tables(manifests, part_file)
+        except Exception:
+            # Don't leave partial part files behind for a failed server
+            for table in TABLES:
+                if os.path.exists(table_path(part_file, table)):
+                    os.remove(table_path(part_file, table))
+            raise
+        return part_file
+
+    # Select the servers for the server type, either a single server or all of them
+    servers = config['arcgis_servers'] if server_type == 'map' else config['arcgis_image_servers']
     if server_name:
-        if server_name in config:
-            site = config[server_name]
-            print(f"\nProcessing server: {server_name}")
-            process_server(site['admin'], server_name)
+        if server_name in servers:
+            servers = {server_name: servers[server_name]}
         else:
             print(f"Server name '{server_name}' not found in the config file.")
-    else:
-        for name, site in config.items():
-            print(f"Processing server: {name}")
-            process_server(site['admin'], name)
-
-    # Create a DataFrame from the list of formatted dictionaries
-    if all_formatted_data:
-        df = pd.DataFrame(all_formatted_data)
-        # Ensure 'server_name' and 'service_name' are the first columns
-        columns = ['server_name', 'directory', 'service_name'] + [col for col in df.columns if col not in ['server_name', 'directory', 'service_name']]
-        df = df[columns]
-
-        # Save the DataFrame to a CSV file
-        try:
-            outfile = os.path.join(out_dir, out_name)
-            df.to_csv(outfile, index=False)
-            print(f"\nData saved to {outfile}")
-        except Exception as e:
-            print(f"\nFailed to save data to CSV file '{outfile}': {e}")
-    else:
+            servers = {}
+
+    # Prompt for credentials once before the servers are processed in parallel, the manifests are requested through a
+    # Server login so the credentials are needed even when a token is cached
+    if servers:
+        Authenticate_ArcGISServer.get_creds()
+
+    # Process the servers in parallel, the part files of each table are merged in config order
+    part_files = [part_file for _, part_file in run_sites(servers, process_server, max_sites)]
+
+    if store:
+        store.close()
+
+    # Save the manifests as long tables, one CSV per table
+    if not any(part_files):
         print("No data to save.")
+        return
+
+    with Instrument_ArcGISServer.span('output', outfile):
+        for table in TABLES:
+            path = table_path(outfile, table)
+            merge_part_files([table_path(part_file, table) for part_file in part_files if part_file], path)
+            print(f"\nData saved to {path}")
 
 if __name__ == '__main__':
     main()
@@ -1,91 +1,167 @@
-import requests
 from xml.etree import ElementTree as ET
 import pandas as pd
 import json
 import click
 import os
 import re
-from Authenticate_ArcGISServer import get_token  # Using the provided get_token script
-from arcgis.gis.server import Server
-
-def get_manifest(username, password, admin_url, rest_url, token):
-    server = Server(url=admin_url, username=username, password=password)
-    directories = server.services.folders
-    dir_ignore = ['System', 'Utilities', r'/']
-
-    combined_manifest = ET.Element('CombinedManifest')
-
-    for dir in directories:
-        if dir not in dir_ignore:
-            try:
-                for service in server.services.list(folder=dir):
-                    endpoint = rest_url.rsplit('/', 3)[-3]
-                    service_url = f"{rest_url}/{dir}/{service.properties.serviceName}/{service.properties.type}"
-                    manifest_url = f"{service.url}/iteminfo/manifest/manifest.xml?&token={token}"
-                    response = requests.get(manifest_url)
-                    if response.status_code == 200:
-                        service_manifest = ET.fromstring(response.content)
-                        service_manifest.set('Endpoint', endpoint)
-                        service_manifest.set('serviceDir', dir)
-                        service_manifest.set('serviceName', service.properties.serviceName)
-                        service_manifest.set('serviceType', service.properties.type)
-                        service_manifest.set('serviceURL', service_url)
-                        combined_manifest.append(service_manifest)
-                    else:
-                        click.echo(f"Failed to retrieve XML from URL for service {service.properties.serviceName}")
-            except Exception as e:
-                click.echo(f"Error: {e}")
-
-    return combined_manifest
-
-def parse_xml_to_df(xml):
-    data = []
-
-    for child in xml.findall('.//SVCManifest'):
-        endpoint = child.attrib.get('Endpoint')
-        service_dir = child.attrib.get('serviceDir')
-        service_name = child.attrib.get('serviceName')
-        service_type = child.attrib.get('serviceType')
-        service_url = child.attrib.get('serviceURL')
-        resource_path = [resource.find('OnPremisePath').text if resource.find('OnPremisePath') is not None else "N/A" for resource in child.findall('.//SVCResource')]
-        
-        # Check for SVCDatabase elements
-        databases = child.findall('.//SVCDatabase')
-        if not databases:  # If no SVCDatabase elements are found
-            # Append row with "N/A" for database-specific fields
-            data.append([
-                endpoint, service_dir, service_name, service_type, service_url,
-                "N/A", "N/A", "N/A", resource_path
-            ])
-        else:
-            # Parse SVCDatabase elements if they exist
-            for db in databases:
-                for dataset in db.findall('.//SVCDataset'):
-                    dataset_name = dataset.find('Name').text if dataset.find('Name') is not None else "N/A"
-                    dataset_type = dataset.find('DatasetType').text if dataset.find('DatasetType') is not None else "N/A"
-                    dataset_path = dataset.find('OnPremisePath').text if dataset.find('OnPremisePath') is not None else "N/A"
-                    
-                    # Append dataset details
-                    data.append([
-                        endpoint, service_dir, service_name, service_type, service_url,
-                        dataset_name, dataset_type, dataset_path, resource_path  
-                    ])
-                
-    # Define column names
-    columns = [
-        'Endpoint', 'ServiceDir', 'ServiceName', 'ServiceType', 'Service_URL',
-        'DatasetName', 'DatasetType', 'DatasetPath', 'ResourcePath'
-    ]
-    df = pd.DataFrame(data, columns=columns)
+import io
+import functools
+from Authenticate_ArcGISServer import get_creds, get_token, get_server  # Using the provided get_token script
+from CrawlServices_ArcGISServer import crawl_services, list_services_report, run_sites, merge_part_files, site_max_workers, site_limiter, CrawlFailures, DEFAULT_MAX_WORKERS, DEFAULT_MAX_SITES  # custom script
+import Transport_ArcGISServer  # custom script
+import Instrument_ArcGISServer  # custom script
+from StateStore_ArcGISServer import incremental, open_store  # custom script
+from Journal_ArcGISServer import RunJournal, journaled  # custom script
+from DatasourceIndex_ArcGISServer import open_index  # custom script
+
+COLUMNS = [
+    'Endpoint', 'ServiceDir', 'ServiceName', 'ServiceType', 'Service_URL',
+    'DatasetName', 'DatasetType', 'DatasetPath', 'ResourcePath'
+]
+CHUNK_SIZE = 5000  # rows written to the CSV at a time
+STATE_KIND = 'manifest_xml_v2'  # state store kind, changed whenever the row format changes
+
+# Last two parts of a dataset path, e.g. the .sde connection file and feature class of an SDE path or the folder and
+# file of a UNC or local path. Either separator is accepted.
+DATASET_PARTS = re.compile(r'([^\\/]+)[\\/]([^\\/]+)$')
+
+# Parse a single manifest.xml into rows in one streaming pass, each element is looked up once and cleared once read
+def parse_manifest(content, service_info):
+    resource_path = []
+    datasets = []
+    has_database = False
+    database_depth = 0
+
+    events = ET.iterparse(io.BytesIO(content), events=('start', 'end'))
+    _, root = next(events)
+    if root.tag != 'SVCManifest':
+        return []
+
+    for event, elem in events:
+        if event == 'start':
+            if elem.tag == 'SVCDatabase':
+                has_database = True
+                database_depth += 1
+            continue
+
+        if elem.tag == 'SVCResource':
+            paths = [child.text for child in elem if child.tag == 'OnPremisePath']
+            resource_path.append(paths[0] if paths else "N/A")
+            elem.clear()
+        elif elem.tag == 'SVCDataset' and database_depth:
+            values = {'Name': "N/A", 'DatasetType': "N/A", 'OnPremisePath': "N/A"}
+            for child in elem:
+                if child.tag in values and values[child.tag] == "N/A":
+                    values[child.tag] = child.text
+            datasets.append((values['Name'], values['DatasetType'], values['OnPremisePath']))
+            elem.clear()
+        elif elem.tag == 'SVCDatabase':
+            database_depth -= 1
+            elem.clear()
+
+    # The resource paths are the same for every row of a service, so they are formatted once here
+    resource_path = '; '.join(path if path else "N/A" for path in resource_path) if resource_path else "N/A"
+
+    if not has_database:
+        # Row with "N/A" for database-specific fields
+        return [service_info + ["N/A", "N/A", "N/A", resource_path]]
+
+    return [service_info + list(dataset) + [resource_path] for dataset in datasets]
+
+# Fetch and parse the manifest for a single service
+def get_service_manifest(rest_url, token, dir, service):
+    endpoint = rest_url.rsplit('/', 3)[-3]
+    service_url = f"{rest_url}/{dir}/{service.properties.serviceName}/{service.properties.type}"
+    manifest_url = f"{service.url}/iteminfo/manifest/manifest.xml?&token={token}"
+    response = Transport_ArcGISServer.get(manifest_url)
+    if response.status_code != 200:
+        # Raised so the crawl counts the failure and the site limiter backs off on error responses
+        raise RuntimeError(f"Failed to retrieve XML from URL for service {service.properties.serviceName} (HTTP {response.status_code})")
+
+    service_info = [endpoint, dir, service.properties.serviceName, service.properties.type, service_url]
+    return parse_manifest(response.content, service_info)
+
+# Fetch the manifests concurrently and yield the rows for each service in listing order as they arrive.
+# With a limiter the concurrency adapts to the site between its floor and ceiling instead of staying at max_workers.
+# Services that fail are counted in failures.
+def get_manifest(username, password, admin_url, rest_url, token, max_workers=DEFAULT_MAX_WORKERS, store=None, bulk_listing=False, journal=None, limiter=None, failures=None):
+    # Unchanged services come from the state store and services already in the run journal are skipped
+    service_manifest = incremental(store, admin_url, STATE_KIND, functools.partial(get_service_manifest, rest_url, token))
+    service_manifest = journaled(journal, admin_url, service_manifest)
+
+    # List whole directories from the admin services report, one request per directory
+    if bulk_listing:
+        services = list_services_report(admin_url, token, max_workers, limiter=limiter, failures=failures)
+        yield from crawl_services(None, service_manifest, max_workers, services=services, limiter=limiter, failures=failures)
+        return
+
+    server = get_server(admin_url, username, password)
+    yield from crawl_services(server, service_manifest, max_workers, limiter=limiter, failures=failures)
+
+# Build the output DataFrame for a chunk of manifest rows
+def parse_xml_to_df(rows):
+    df = pd.DataFrame(rows, columns=COLUMNS)
+
+    # Split the dataset paths in one vectorised pass, paths that don't match get "N/A"
+    dataset_path = df['DatasetPath'].astype('string').mask(df['DatasetPath'] == "N/A").str.rstrip('\\/')
+    df[['DatasetPart1', 'DatasetPart2']] = dataset_path.str.extract(DATASET_PARTS).fillna("N/A").astype(object)
+
     return df
 
+# Write a chunk of manifest rows to the CSV, the header is only written with the first chunk.
+# The rows are also added to the datasource index when there is one.
+def write_rows(rows, outfile, header, index=None):
+    with Instrument_ArcGISServer.span('output', outfile, rows=len(rows)):
+        df = parse_xml_to_df(rows)
+        df.to_csv(outfile, mode='w' if header else 'a', header=header, index=False)
+        if index:
+            index.add_manifest_rows(df)
+
+# Writes the rows of each service to the CSV in chunks of CHUNK_SIZE as they arrive
+class ManifestRowsWriter:
+    def __init__(self, outfile, index=None):
+        self.outfile = outfile
+        self.index = index
+        self.rows_written = 0
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, service_rows):
+        self._rows.extend(service_rows)
+        if len(self._rows) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        write_rows(self._rows, self.outfile, header=self.rows_written == 0, index=self.index)
+        self.rows_written += len(self._rows)
+        self._rows = []
+
+    # Save the remaining rows, nothing is written when there were none
+    def close(self):
+        if self._rows:
+            self.flush()
+
 @click.command()
+@Instrument_ArcGISServer.instrumented
 @click.option('--gis_sites_json', type=click.Path(exists=True), default=None, help='Path to the JSON file containing GIS site data.')
 @click.option('--out_dir', type=click.Path(), default=None, help='Output directory for the CSV file.')
 @click.option('--out_name', default=None, help='Output filename for the CSV file. Please specify extension')
 @click.option('--server_type', type=click.Choice(['map', 'image']), default='map', help='Choose between ArcGIS (map) or ArcGIS ImageServer (image).')
+@click.option('--max_workers', type=int, default=None, help='Most concurrent requests per site, the crawl adapts between min_workers and this. Overrides max_workers in the JSON file.')
+@click.option('--timeout', type=int, default=None, help='Seconds to wait for a manifest response before retrying.')
+@click.option('--state_db', type=click.Path(), default=None, help='SQLite state store, only new or changed services are re-fetched.')
+@click.option('--max_sites', type=int, default=DEFAULT_MAX_SITES, help='Number of servers to process at the same time.')
+@click.option('--bulk_listing', is_flag=True, default=False, help='List services with one admin report request per directory.')
+@click.option('--journal', 'journal_path', type=click.Path(), default=None, help='Run journal for checkpointing. Defaults to a .journal file in the output directory.')
+@click.option('--resume', is_flag=True, default=False, help='Carry on from the run journal of a run that did not complete.')
+@click.option('--index_db', type=click.Path(), default=None, help='Also add the dataset paths to the SQLite datasource index.')
 
-def main(gis_sites_json, out_dir, out_name, server_type):
+def main(gis_sites_json, out_dir, out_name, server_type, max_workers, timeout, state_db, max_sites, bulk_listing, journal_path, resume, index_db):
     # Set default paths and filenames
     default_json = r"..."
     gis_sites_json = gis_sites_json if gis_sites_json else default_json
@@ -101,7 +177,51 @@ def main(gis_sites_json, out_dir, out_name, server_type):
     out_name = out_name if out_name else default_name
     outfile = os.path.join(out_dir, out_name)
 
-    all_dfs = []
+    store = open_store(state_db)
+    index = open_index(index_db)
+    part_files = []
+
+    # Checkpoint finished services so a failed run can be resumed, the part files are rebuilt from the journal. The default
+    # journal name has no date, so a run that died before midnight can still be resumed the day after.
+    journal_path = journal_path if journal_path else os.path.join(out_dir, f"ServicesManifest_XML_{server_type}.journal")
+    journal = RunJournal(journal_path, resume)
+    completed_sites = []
+
+    # Process a single server, its rows are written to its own part file in chunks as the manifests arrive
+    def process_server(server_name, server_info):
+        # Extract admin and rest URLs
+        admin_url = server_info['admin']
+        rest_url = server_info['rest']
+        token_url = f"{admin_url}/generateToken"
+        part_file = f"{outfile}.{server_name}.part"
+
+        # Retrieve token, cached tokens are reused
+        auth = get_token(server_name, token_url, username, password)
+        token = auth[2] if auth else None
+
+        if not token:
+            click.echo(f"\nFailed to authenticate with server '{server_name}'.")
+            return None
+
+        limiter = site_limiter(server_name, server_info, max_workers)
+        failures = CrawlFailures()
+        with ManifestRowsWriter(part_file, index) as writer:
+            for service_rows in get_manifest(username, password, admin_url, rest_url, token, limiter.max_workers, store, bulk_listing, journal, limiter, failures):
+                writer.write(service_rows)
+        rows_written = writer.rows_written
+
+        click.echo(f'\nAcquired service manifest: {server_name}')
+        # A token expiry or dropped connection part way fails the rest of the services, keep the journal to resume them
+        if failures.count:
+            click.echo(f"{server_name}: {failures.count} service(s) or directories failed, run again with --resume to fetch them")
+        else:
+            completed_sites.append(server_name)
+            # Every service of the site was seen, so the index rows of services that are gone can be removed
+            if index:
+                removed = index.purge_services(rest_url)
+                if removed:
+                    click.echo(f"{server_name}: removed {removed} service(s) no longer on the site from the datasource index")
+        return part_file if rows_written else None
 
     try:
         with open(gis_sites_json, 'r') as json_file:
@@ -113,44 +233,35 @@ def main(gis_sites_json, out_dir, out_name, server_type):
         else:
             available_servers = server_data["arcgis_image_servers"]
 
-        # Loop through all selected servers and process each one
-        for server_name, server_info in available_servers.items():
-            # Extract admin and rest URLs
-            admin_url = server_info['admin']
-            rest_url = server_info['rest']
-            token_url = f"{admin_url}/generateToken"
+        # Size the connection pools to the busiest site
+        pool_size = max(site_max_workers(server_info, max_workers) for server_info in available_servers.values())
+        Transport_ArcGISServer.configure(pool_size=pool_size, timeout=timeout)
 
-            # Authenticate and retrieve token
-            username, password, token = get_token(server_name, token_url)
+        # The Server login used to list the services needs the credentials, so they are prompted for once up front.
+        # The bulk listing only needs a token, and the credentials are only prompted for if there is no cached token.
+        username, password = get_creds() if not bulk_listing else (None, None)
 
-            if token:
-                combined_manifest = get_manifest(username, password, admin_url, rest_url, token)
-                df = parse_xml_to_df(combined_manifest)
-                click.echo(f'\nAcquired service manifest: {server_name}')
-                all_dfs.append(df)
-            else:
-                click.echo(f"\nFailed to authenticate with server '{server_name}'.")
+        # Process the servers in parallel, the part files are merged in config order
+        part_files = [part_file for _, part_file in run_sites(available_servers, process_server, max_sites)]
 
     except Exception as e:
+        available_servers = None
         click.echo(f"\nError: {e}")
 
-    # Combine dataframes and save to CSV
-    if all_dfs:
-        combined_df = pd.concat(all_dfs, ignore_index=True)
-
-        combined_df[['DatasetPart1', 'DatasetPart2']] = combined_df['DatasetPath'].apply(
-        lambda x: re.search(r'([^\\]+)\\([^\\]+)$', x).groups() if pd.notna(x) else ("N/A", "N/A")
-    ).apply(pd.Series)
-        
-        combined_df['ResourcePath'] = combined_df['ResourcePath'].apply(
-        lambda x: re.sub(r"^\[\'\\\\|\'\]$", '', str(x)).replace('\\\\', '\\') if isinstance(x, list) else "N/A"
-    )
-        #click.echo(combined_df)
-        combined_df.to_csv(outfile, index=False)
+    if store:
+        store.close()
+    if index:
+        index.close()
+
+    if merge_part_files(part_files, outfile):
         click.echo(f'\nCSV saved to {outfile}')
     else:
         click.echo("\nNo data retrieved. CSV file not saved.")
 
+    # The journal is only kept when a site failed or has unfinished services, so it can be resumed
+    journal.close(available_servers is not None and len(completed_sites) == len(available_servers))
+
+    Transport_ArcGISServer.print_stats()
     click.echo("\nScript complete.")
 
 if __name__ == "__main__":
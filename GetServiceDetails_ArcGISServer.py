@@ -2,19 +2,36 @@
 This script gets information about web services for reporting, the script will get the site details from gis_sites.json and requires an administration account to successfully run. 
 Can also be run in cmd line with the following:
 
-    GetServiceDetails_ArcGIS_Server.py --out_dir "C:\directory..." --out_name "Filename.csv" --gis_sites_json "C:\...\test_json.json" --server_type "map"
+    GetServiceDetails_ArcGIS_Server.py --out_dir "C:\directory..." --out_name "Filename.csv" --gis_sites_json "C:\...\test_json.json" --server_type "map" --max_workers 8 --state_db "C:\\...\\inventory_state.db"
+
+The create dates are harvested from the service metadata after the services are crawled, concurrently and with
+conditional requests against the metadata cache in the state store (see MetadataHarvest_ArcGISServer.py). With a state
+store, unchanged services keep the create date saved with them and only new or changed services are harvested.
+With --snapshot_db the catalogue is also saved as a snapshot that later runs can be compared to
+(see SnapshotStore_ArcGISServer.py).
 
 '''
 
 import Authenticate_ArcGISServer  # custom script
+from CrawlServices_ArcGISServer import crawl_services, list_services, list_services_report, run_sites, merge_part_files, site_max_workers, site_limiter, DEFAULT_MAX_WORKERS, DEFAULT_MAX_SITES  # custom script
+import Transport_ArcGISServer  # custom script
+import Instrument_ArcGISServer  # custom script
+import MetadataHarvest_ArcGISServer  # custom script
+from StateStore_ArcGISServer import incremental, open_store  # custom script
+from CsvWriter_ArcGISServer import CsvWriter  # custom script
+from SnapshotStore_ArcGISServer import open_snapshots, read_csv_rows  # custom script
 import click
 import pandas as pd
 import collections
+import functools
 import os
 import json
-import requests
-import xml.etree.ElementTree as ET
-from arcgis.gis.server import Server
+
+COLUMNS = [
+    'Site', 'Directory', 'Service_Name', 'Service_Type', 'Access', 'Server_Type', 'Is_Private',
+    'Feature_Server', 'Kml_Server', 'WFS_Server', 'WMS_Server', 'Create_Date', 'Service_URL'
+]
+STATE_KIND = 'details'  # state store kind
 
 # Helper function to check enabled capabilities
 def enabled_capabilities(extensions_list):
@@ -33,79 +50,91 @@ def enabled_capabilities(extensions_list):
 
     return capabilities
 
-# Function to get service details for a given server
-def get_service_details(site, access, server_type, admin_url, rest_url, username, password):
-    temp_list = []
-    
-    # Create a Server instance (stand-alone/unfederated ArcGIS Server site)
-    server = Server(admin_url, username=username, password=password)
-
-    # Find directories
-    directories = server.services.folders
-    dir_ignore = ['System', 'Utilities', r'/']
-
-    # Print services
-    for dir in directories:
-        if dir not in dir_ignore:
-            try:
-                for service in server.services.list(folder=dir):
-                    capabilities = enabled_capabilities(service.properties.extensions)
-
-                    temp_dict = collections.OrderedDict()
-                    temp_dict['Site'] = site
-                    temp_dict['Directory'] = 'Root' if dir == r'/' else dir
-                    temp_dict['Service_Name'] = service.properties.serviceName
-                    temp_dict['Service_Type'] = service.properties.type
-                    temp_dict['Access'] = access
-                    temp_dict['Server_Type'] = server_type
-                    temp_dict['Is_Private'] = service.properties.private
-                    temp_dict['Feature_Server'] = capabilities['FeatureServer']
-                    temp_dict['Kml_Server'] = capabilities['KmlServer']
-                    temp_dict['WFS_Server'] = capabilities['WFSServer']
-                    temp_dict['WMS_Server'] = capabilities['WMSServer']
-                    metadata_url = f"{rest_url}/{dir}/{service.properties.serviceName}/{service.properties.type}/info/metadata"
-                    create_date = get_create_date(metadata_url)
-                    temp_dict['Create_Date'] = create_date
-                    temp_dict['Service_URL'] = f"{rest_url}/{dir}/{service.properties.serviceName}/{service.properties.type}"
-                    temp_list.append(temp_dict)
-
-            except Exception as e:
-                print(e)
-
-    return temp_list
+# Function to get the details of a single service
+def get_service_row(site, access, server_type, rest_url, dir, service):
+    capabilities = enabled_capabilities(service.properties.extensions)
+
+    temp_dict = collections.OrderedDict()
+    temp_dict['Site'] = site
+    temp_dict['Directory'] = 'Root' if dir == r'/' else dir
+    temp_dict['Service_Name'] = service.properties.serviceName
+    temp_dict['Service_Type'] = service.properties.type
+    temp_dict['Access'] = access
+    temp_dict['Server_Type'] = server_type
+    temp_dict['Is_Private'] = service.properties.private
+    temp_dict['Feature_Server'] = capabilities['FeatureServer']
+    temp_dict['Kml_Server'] = capabilities['KmlServer']
+    temp_dict['WFS_Server'] = capabilities['WFSServer']
+    temp_dict['WMS_Server'] = capabilities['WMSServer']
+    temp_dict['Create_Date'] = None  # filled in from the metadata by add_create_dates
+    temp_dict['Service_URL'] = f"{rest_url}/{dir}/{service.properties.serviceName}/{service.properties.type}"
+
+    return temp_dict
+
+# Function to get service details for a given server, with a limiter the concurrency adapts to the site
+def get_service_details(site, access, server_type, admin_url, rest_url, username, password, max_workers=DEFAULT_MAX_WORKERS, store=None, bulk_listing=False, limiter=None):
+    # Crawl the services in each directory concurrently, unchanged services come from the state store
+    service_row = incremental(store, admin_url, STATE_KIND, functools.partial(get_service_row, site, access, server_type, rest_url))
+
+    # List whole directories from the admin services report, one request per directory
+    if bulk_listing:
+        auth = Authenticate_ArcGISServer.get_token(site, f"{admin_url}/generateToken", username, password)
+        if not auth:
+            print(f"Failed to authenticate with server '{site}'.")
+            return []
+        services = list_services_report(admin_url, auth[2], max_workers, limiter=limiter)
+    else:
+        # Create a Server instance (stand-alone/unfederated ArcGIS Server site)
+        server = Authenticate_ArcGISServer.get_server(admin_url, username, password)
+        services = list_services(server, max_workers, limiter=limiter)
+
+    # The rows are built from the listing without any requests, so only the listing and the metadata requests
+    # are run in the limiter's slots
+    rows = list(crawl_services(None, service_row, max_workers, services=services))
+    return add_create_dates(rows, store, max_workers, limiter, admin_url)
+
+# Function to fill in the Create_Date of the service rows from their metadata, the rows are updated in place.
+# Rows of unchanged services come from the state store with the create date they were saved with, so only new or
+# changed services (and ones whose create date could not be found before) are harvested. Their create dates are
+# saved with their rows under the site's admin_url. With a limiter the metadata requests run in its slots and adjust it.
+def add_create_dates(rows, store=None, max_concurrency=DEFAULT_MAX_WORKERS, limiter=None, admin_url=None):
+    pending = [row for row in rows if not row['Create_Date']]
+    urls = [f"{row['Service_URL']}/info/metadata" for row in pending]
+    create_dates = MetadataHarvest_ArcGISServer.harvest_create_dates(urls, store, max_concurrency, limiter)
+    for row, create_date in zip(pending, create_dates):
+        row['Create_Date'] = create_date
+        if store and admin_url and create_date:
+            dir = r'/' if row['Directory'] == 'Root' else row['Directory']
+            store.update(admin_url, dir, f"{row['Service_Name']}.{row['Service_Type']}", STATE_KIND, row)
+    return rows
 
 # Function to get the creation date of the service from its metadata
 def get_create_date(service_metadata_url):
-    try:
-        response = requests.get(service_metadata_url)
-        if response.status_code == 200:
-            metadata_xml = response.text
-            root = ET.fromstring(metadata_xml)
-            esri_element = root.find(".//Esri")
-            create_date_element = esri_element.find("CreaDate")
-            create_date = create_date_element.text if create_date_element is not None else ''
-            return create_date
-        else:
-            return ''
-    except Exception as e:
-        return ''
+    return MetadataHarvest_ArcGISServer.fetch_create_date(service_metadata_url)
 
-# Function to export data to a CSV
+# Function to export data to a CSV, the rows are streamed to the file in the COLUMNS order
 def export_to_csv(data, outdir, outname):
-    # Create DataFrame and output to screen for review
-    df = pd.DataFrame(data=data)
     outfile = os.path.join(outdir, outname)
-    df.to_csv(outfile, index=False)
+    with Instrument_ArcGISServer.span('output', outfile, rows=len(data)):
+        with CsvWriter(outfile, COLUMNS) as writer:
+            writer.write_rows(data)
     print(f'CSV saved as: {outfile}')
 
 # CLICK commands for handling command-line inputs
 @click.command()
+@Instrument_ArcGISServer.instrumented
 @click.option('--out_dir', type=click.Path(exists=True), default=None, help='Output directory for the CSV file.')
 @click.option('--out_name', default=None, help='Output filename for the CSV file. Please specify extension')
 @click.option('--gis_sites_json', type=click.Path(exists=True), default=None, help='Path to the JSON file containing GIS site data.')
 @click.option('--server_type', type=click.Choice(['map', 'image']), default='map', help='Choose between ArcGIS or ArcGIS ImageServer.')
-
-def main(out_dir, out_name, gis_sites_json, server_type):
+@click.option('--max_workers', type=int, default=None, help='Most concurrent requests per site, the crawl adapts between min_workers and this. Overrides max_workers in the JSON file.')
+@click.option('--timeout', type=int, default=None, help='Seconds to wait for a metadata response before retrying.')
+@click.option('--state_db', type=click.Path(), default=None, help='SQLite state store, only new or changed services are re-fetched.')
+@click.option('--max_sites', type=int, default=DEFAULT_MAX_SITES, help='Number of sites to crawl at the same time.')
+@click.option('--bulk_listing', is_flag=True, default=False, help='List services with one admin report request per directory.')
+@click.option('--snapshot_db', type=click.Path(), default=None, help='SQLite snapshot store, the catalogue is saved as a snapshot named after the CSV.')
+
+def main(out_dir, out_name, gis_sites_json, server_type, max_workers, timeout, state_db, max_sites, bulk_listing, snapshot_db):
     
     default_dir = r'...'
     out_dir = out_dir if out_dir else default_dir
@@ -120,21 +149,58 @@ def main(out_dir, out_name, gis_sites_json, server_type):
     with open(gis_sites_json, 'r') as json_file:
         server_data = json.load(json_file)
 
-    service_list = []
+    outfile = os.path.join(out_dir, out_name)
+    store = open_store(state_db)
 
-    username, password = Authenticate_ArcGISServer.get_creds()
+    # The Server login used to list the services needs the credentials, so they are prompted for once up front.
+    # The bulk listing only needs a token, and the credentials are only prompted for if there is no cached token.
+    username, password = Authenticate_ArcGISServer.get_creds() if not bulk_listing else (None, None)
 
     # Select correct server data based on user input (ArcGIS or ImageServer)
     selected_servers = server_data['arcgis_servers'] if server_type == 'map' else server_data['arcgis_image_servers']
+
+    # Size the connection pools to the busiest site
+    pool_size = max(site_max_workers(server_info, max_workers) for server_info in selected_servers.values())
+    Transport_ArcGISServer.configure(pool_size=pool_size, timeout=timeout)
     
-    for site, server_info in selected_servers.items():
+    # Each site's rows are written to its own part file once its create dates are filled in
+    def site_details(site, server_info):
         admin_url = server_info['admin']
         rest_url = server_info['rest']
         access = server_info['access']
-        service_list.extend(get_service_details(site, access, server_type, admin_url, rest_url, username, password))
+        limiter = site_limiter(site, server_info, max_workers)
+        temp_list = get_service_details(site, access, server_type, admin_url, rest_url, username, password, limiter.max_workers, store, bulk_listing, limiter)
+
+        part_file = f"{outfile}.{site}.part"
+        with CsvWriter(part_file, COLUMNS) as writer:
+            writer.write_rows(temp_list)
         print(f'Acquired service details: {site}')
+        return part_file
+
+    # Crawl the sites in parallel, the part files are merged in config order
+    part_files = [part_file for _, part_file in run_sites(selected_servers, site_details, max_sites)]
 
-    export_to_csv(service_list, out_dir, out_name)
+    if store:
+        store.close()
+
+    with Instrument_ArcGISServer.span('output', outfile):
+        if not merge_part_files(part_files, outfile):
+            print("No service details retrieved. CSV file not saved.")
+            outfile = None
+        else:
+            print(f'CSV saved as: {outfile}')
+
+    # The snapshot is read back from the CSV a row at a time, a rerun with the same output name replaces it
+    snapshots = open_snapshots(snapshot_db)
+    if snapshots:
+        if outfile:
+            snapshot_name = os.path.splitext(out_name)[0]
+            with Instrument_ArcGISServer.span('snapshot', snapshot_name):
+                snapshots.save(snapshot_name, server_type, read_csv_rows(outfile))
+            print(f"Snapshot saved as '{snapshot_name}' in: {snapshot_db}")
+        snapshots.close()
+
+    Transport_ArcGISServer.print_stats()
     print("Script complete.")
 
 if __name__ == '__main__':
@@ -0,0 +1,218 @@
+'''
+This script runs the service inventory in a single pass. Each site is logged in to and enumerated once, and the selected
+collectors run over the same service handles:
+
+    details        - service details, capabilities and metadata create date (as GetServiceDetails_ArcGISServer.py)
+    usage          - last year of request counts from the quick reports (as GetServiceUsage_ArcGIS_Server.py)
+    manifest_xml   - datasets and resources from the manifest.xml (as GetManifestXML_ArcGISServer.py)
+    manifest_json  - the manifest.json as services, databases, datasets and resources tables (as GetManifestJson_ArcGISServer.py)
+
+Each dataset is streamed to its own CSV, with the same default names and columns as the separate scripts. Each site's
+results are written to part files as they arrive and the part files are merged in config order once every site is done.
+The script will get the site details from gis_sites.json and requires an administration account to successfully run.
+Can also be run in cmd line with the following:
+
+    GetServiceInventory_ArcGISServer.py --out_dir "C:\directory..." --gis_sites_json "C:\...\test_json.json" --server_type "map" --collector details --collector usage
+
+'''
+
+import Authenticate_ArcGISServer  # custom script
+from CrawlServices_ArcGISServer import crawl_services, run_sites, merge_part_files, site_max_workers, site_limiter, CrawlFailures, PartialResult, DEFAULT_MAX_SITES  # custom script
+import Transport_ArcGISServer  # custom script
+import Instrument_ArcGISServer  # custom script
+from StateStore_ArcGISServer import incremental, open_store  # custom script
+from CsvWriter_ArcGISServer import CsvWriter  # custom script
+import GetServiceDetails_ArcGISServer  # custom script
+import GetServiceUsage_ArcGIS_Server  # custom script
+import GetManifestXML_ArcGISServer  # custom script
+import GetManifestJson_ArcGISServer  # custom script
+import click
+import pandas as pd
+import functools
+import json
+import os
+
+# Collector functions build the per-service function for a site, the writer functions open the writer a site's results
+# are streamed to one at a time (anything with write and close)
+
+def details_collector(site, server_info, server_type, server, token, store):
+    service_row = functools.partial(GetServiceDetails_ArcGISServer.get_service_row, site, server_info['access'], server_type, server_info['rest'])
+    return incremental(store, server_info['admin'], GetServiceDetails_ArcGISServer.STATE_KIND, service_row)
+
+def usage_collector(site, server_info, server_type, server, token, store):
+    return functools.partial(GetServiceUsage_ArcGIS_Server.get_service_usage, server, site)
+
+def manifest_xml_collector(site, server_info, server_type, server, token, store):
+    service_manifest = functools.partial(GetManifestXML_ArcGISServer.get_service_manifest, server_info['rest'], token)
+    return incremental(store, server_info['admin'], GetManifestXML_ArcGISServer.STATE_KIND, service_manifest)
+
+def manifest_json_collector(site, server_info, server_type, server, token, store):
+    service_manifest = functools.partial(GetManifestJson_ArcGISServer.get_service_manifest, site)
+    return incremental(store, server_info['admin'], 'manifest_json', service_manifest)
+
+def details_writer(outfile):
+    return CsvWriter(outfile, GetServiceDetails_ArcGISServer.COLUMNS)
+
+def usage_writer(outfile):
+    return CsvWriter(outfile, GetServiceUsage_ArcGIS_Server.COLUMNS, explode=GetServiceUsage_ArcGIS_Server.EXPLODE_COLUMNS,
+                     formatters={'Time_Slice': GetServiceUsage_ArcGIS_Server.format_time_slices})
+
+# The manifest rows are written in chunks so the dataset path split runs on one chunk at a time
+def manifest_xml_writer(outfile):
+    return GetManifestXML_ArcGISServer.ManifestRowsWriter(outfile)
+
+def manifest_json_writer(outfile):
+    return GetManifestJson_ArcGISServer.ManifestTablesWriter(outfile)
+
+# name: (collector, output writer, default output name)
+COLLECTORS = {
+    'details': (details_collector, details_writer, 'GIS_Services_{server_type}_{date}.csv'),
+    'usage': (usage_collector, usage_writer, 'GIS_Services_{server_type}_Usage_{date_time}.csv'),
+    'manifest_xml': (manifest_xml_collector, manifest_xml_writer, 'ServicesManifest_XML_{date}.csv'),
+    'manifest_json': (manifest_json_collector, manifest_json_writer, 'ServicesManifest_JSON_{date}.csv'),
+}
+
+# The files a collector writes for an output path, the JSON manifests are written as one CSV per table
+def output_paths(name, outfile):
+    if name == 'manifest_json':
+        return [GetManifestJson_ArcGISServer.table_path(outfile, table) for table in GetManifestJson_ArcGISServer.TABLES]
+    return [outfile]
+
+def remove_outputs(name, outfile):
+    for path in output_paths(name, outfile):
+        if os.path.exists(path):
+            os.remove(path)
+
+# Enumerate a site once and run every collector over each service. Each collector's results are streamed to a part
+# file next to its output in listing order, returns the part file for each collector (None when it got no results).
+def collect_site(site, server_info, server_type, collectors, outfiles, username, password, max_workers=None, store=None):
+    admin_url = server_info['admin']
+    server = Authenticate_ArcGISServer.get_server(admin_url, username, password)
+
+    # Only the XML manifests are requested with a token outside the Server object
+    token = None
+    if 'manifest_xml' in collectors:
+        auth = Authenticate_ArcGISServer.get_token(site, f"{admin_url}/generateToken", username, password)
+        token = auth[2] if auth else None
+
+    service_funcs = {name: COLLECTORS[name][0](site, server_info, server_type, server, token, store) for name in collectors}
+
+    # A collector that fails doesn't stop the others, but the service is raised as a partial result so the site limiter
+    # backs off on errors and the failure is counted
+    def collect_service(dir, service):
+        results = {}
+        failed = []
+        for name, func in service_funcs.items():
+            try:
+                results[name] = func(dir, service)
+            except Exception as e:
+                print(f"{site}: {name} failed for service '{service.properties.serviceName}': {e}")
+                results[name] = None
+                failed.append(name)
+        if failed:
+            raise PartialResult(results, f"{', '.join(failed)} failed")
+        return results
+
+    part_files = {name: f"{outfiles[name]}.{site}.part" for name in collectors}
+    writers = {}
+    counts = {name: 0 for name in collectors}
+    details = []
+    failures = CrawlFailures()
+    try:
+        writers = {name: COLLECTORS[name][1](part_files[name]) for name in collectors}
+        limiter = site_limiter(site, server_info, max_workers)
+        for results in crawl_services(server, collect_service, limiter=limiter, failures=failures):
+            for name, result in results.items():
+                if result is None:
+                    continue
+                counts[name] += 1
+                # The details rows wait for their create dates, the other results are written as they arrive
+                if name == 'details':
+                    details.append(result)
+                else:
+                    writers[name].write(result)
+
+        # The create dates of new or changed services are harvested for the whole site at once, in the site limiter's slots
+        if details:
+            GetServiceDetails_ArcGISServer.add_create_dates(details, store, limiter=limiter, admin_url=admin_url)
+            writers['details'].write_rows(details)
+    except Exception:
+        # Don't leave partial part files behind for a failed site
+        for writer in writers.values():
+            writer.close()
+        for name in collectors:
+            remove_outputs(name, part_files[name])
+        raise
+
+    for name, writer in writers.items():
+        writer.close()
+        if not counts[name]:
+            remove_outputs(name, part_files[name])
+
+    print(f'Acquired service inventory: {site}')
+    if failures.count:
+        print(f"{site}: {failures.count} service(s) or directories failed, their results are missing or incomplete")
+    return {name: part_files[name] if counts[name] else None for name in collectors}
+
+# CLICK commands for handling command-line inputs
+@click.command()
+@Instrument_ArcGISServer.instrumented
+@click.option('--out_dir', type=click.Path(exists=True), default=None, help='Output directory for the CSV files.')
+@click.option('--gis_sites_json', type=click.Path(exists=True), default=None, help='Path to the JSON file containing GIS site data.')
+@click.option('--server_type', type=click.Choice(['map', 'image']), default='map', help='Choose between ArcGIS or ArcGIS ImageServer.')
+@click.option('--collector', 'collectors', type=click.Choice(list(COLLECTORS)), multiple=True, default=list(COLLECTORS), help='Collector to run, can be given more than once. Defaults to all of them.')
+@click.option('--max_workers', type=int, default=None, help='Most concurrent requests per site, the crawl adapts between min_workers and this. Overrides max_workers in the JSON file.')
+@click.option('--max_sites', type=int, default=DEFAULT_MAX_SITES, help='Number of sites to crawl at the same time.')
+@click.option('--timeout', type=int, default=None, help='Seconds to wait for a metadata or manifest response before retrying.')
+@click.option('--state_db', type=click.Path(), default=None, help='SQLite state store, only new or changed services are re-fetched.')
+
+def main(out_dir, gis_sites_json, server_type, collectors, max_workers, max_sites, timeout, state_db):
+    default_dir = r'...'
+    out_dir = out_dir if out_dir else default_dir
+
+    default_json = r"..."
+    gis_sites_json = gis_sites_json if gis_sites_json else default_json
+
+    with open(gis_sites_json, 'r') as json_file:
+        server_data = json.load(json_file)
+
+    # Select correct server data based on user input (ArcGIS or ImageServer)
+    selected_servers = server_data['arcgis_servers'] if server_type == 'map' else server_data['arcgis_image_servers']
+
+    # Size the connection pools to the busiest site
+    pool_size = max(site_max_workers(server_info, max_workers) for server_info in selected_servers.values())
+    Transport_ArcGISServer.configure(pool_size=pool_size, timeout=timeout)
+
+    store = open_store(state_db)
+    # Every site is listed through a Server login, which needs the credentials even when a token is cached
+    username, password = Authenticate_ArcGISServer.get_creds()
+
+    now = pd.Timestamp.today()
+    outfiles = {name: os.path.join(out_dir, COLLECTORS[name][2].format(server_type=server_type, date=now.strftime('%Y%m%d'), date_time=now.strftime('%Y%m%d_%H%M%S')))
+                for name in collectors}
+
+    site_inventory = functools.partial(collect_site, server_type=server_type, collectors=list(collectors), outfiles=outfiles,
+                                       username=username, password=password, max_workers=max_workers, store=store)
+
+    # Crawl the sites in parallel, each site streams its results to its own part files
+    site_parts = [site_results for _, site_results in run_sites(selected_servers, site_inventory, max_sites) if site_results]
+
+    if store:
+        store.close()
+
+    # Merge the part files of each dataset into its own CSV in config order
+    for name, outfile in outfiles.items():
+        part_files = [site_results[name] for site_results in site_parts if site_results[name]]
+        if not part_files:
+            print(f'No {name} data retrieved. CSV file not saved.')
+            continue
+        with Instrument_ArcGISServer.span('output', outfile):
+            for index, path in enumerate(output_paths(name, outfile)):
+                merge_part_files([output_paths(name, part_file)[index] for part_file in part_files], path)
+                print(f'CSV saved as: {path}')
+
+    Transport_ArcGISServer.print_stats()
+    print("Script complete.")
+
+if __name__ == '__main__':
+    main()
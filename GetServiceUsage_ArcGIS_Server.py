@@ -4,56 +4,138 @@
 # This script gets quick reports for Requests to a Service at the directory level, the script will get the site details from gis_sites.json and requires an administration account to successfully run.
 # Can also be run in cmd line with the following:
 
-#     GetServiceUsage_ArcGIS_Server.py --out_dir "C:\directory..." --out_name "Filename.csv" --gis_sites_json "C:\...\test_json.json" --server_type "map"
+#     GetServiceUsage_ArcGIS_Server.py --out_dir "C:\directory..." --out_name "Filename.csv" --gis_sites_json "C:\...\test_json.json" --server_type "map" --max_workers 8 --batch_size 50
+
+# Finished services are checkpointed to a run journal in the output directory. If a run dies part way, run it again
+# with --resume and only the services that are not in the journal are requested again.
+# The usage is streamed to the CSV as the reports arrive, with the time slices expanded to one row each on the fly.
+# Time slices are kept as the epoch milliseconds from the API and only formatted as YYYY-MM-DD when they are written.
+# With --rollup_dir the weekly/monthly rollups are updated for the Parquet partitions the run wrote to.
 
 
 import pandas as pd
 import os
 import collections
+import functools
 import click
 import json
-from arcgis.gis.server import Server
 import Authenticate_ArcGISServer  # custom script
+from CrawlServices_ArcGISServer import crawl_services, crawl_service_batches, run_sites, merge_part_files, site_limiter, CrawlFailures, DEFAULT_MAX_WORKERS, DEFAULT_MAX_SITES  # custom script
+from UsageStore_ArcGISServer import write_usage, DATE_FORMAT  # custom script
+from UsageRollup_ArcGISServer import update_rollups  # custom script
+from Journal_ArcGISServer import RunJournal, journaled, journaled_batches  # custom script
+from CsvWriter_ArcGISServer import CsvWriter  # custom script
+import Instrument_ArcGISServer  # custom script
+
+COLUMNS = ['Site', 'Directory', 'Service', 'Service_Type', 'Time_Slice', 'Request_Count']
+EXPLODE_COLUMNS = ['Time_Slice', 'Request_Count']  # one row per time slice in the CSV
+
+# Format epoch-ms time slices as dates, a site's reports share their time slices so each set is only formatted once
+@functools.lru_cache(maxsize=32)
+def _format_epoch_ms(time_slices):
+    return list(pd.to_datetime(list(time_slices), unit='ms').strftime(DATE_FORMAT))
+
+def format_time_slices(time_slices):
+    return _format_epoch_ms(tuple(time_slices))
+
+# Build the usage query for a service
+def service_query(dir, service):
+    return fr'services/{dir}/{service.properties.serviceName}.{service.properties.type}'
+
+# Build the usage row for a service from its resource in a Quick Report
+def usage_row(key, dir, service, time_slices, resource):
+    temp_dict = collections.OrderedDict()
+    temp_dict['Site'] = key
+    temp_dict['Directory'] = 'Root' if dir == r'/' else dir
+    temp_dict['Service'] = service.properties.serviceName
+    temp_dict['Service_Type'] = service.properties.type
+    temp_dict['Time_Slice'] = time_slices
+    temp_dict['Request_Count'] = resource['data']
+    return temp_dict
+
+# Journal key of a usage row, the same as Journal_ArcGISServer.service_key for its service
+def usage_key(row):
+    dir = r'/' if row['Directory'] == 'Root' else row['Directory']
+    return f"{dir}/{row['Service']}.{row['Service_Type']}"
+
+# Get the Quick Report for a single service
+def get_service_usage(server, key, dir, service):
+    query = service_query(dir, service)
+    data = server.usage.quick_report(since="LAST_YEAR", queries=query, metrics="RequestCount")
+    temp_dict = usage_row(key, dir, service, data['report']['time-slices'], data['report']['report-data'][0][0])
+    print(fr'{key}: {query} quick report generated...')
+
+    return temp_dict
+
+# Get the Quick Report for a batch of services with one multi-resource query.
+# The report-data is split back out per service, a batch that fails is split in half and retried.
+def get_batch_usage(server, key, batch):
+    if len(batch) == 1:
+        dir, service = batch[0]
+        try:
+            return [get_service_usage(server, key, dir, service)]
+        except Exception as e:
+            print(e)
+            return []
+
+    queries = [service_query(dir, service) for dir, service in batch]
+    try:
+        data = server.usage.quick_report(since="LAST_YEAR", queries=','.join(queries), metrics="RequestCount")
+        time_slices = data['report']['time-slices']
+        resources = {resource['resourceURI']: resource for resource in data['report']['report-data'][0]}
+        temp_list = [usage_row(key, dir, service, time_slices, resources[query]) for (dir, service), query in zip(batch, queries)]
+    except Exception as e:
+        print(f'{key}: quick report failed for a batch of {len(batch)} services, retrying in smaller batches... ({e})')
+        half = len(batch) // 2
+        return get_batch_usage(server, key, batch[:half]) + get_batch_usage(server, key, batch[half:])
+
+    for query in queries:
+        print(fr'{key}: {query} quick report generated...')
 
-# Get Quick Reports from Server
-def get_quick_reports(admin_url, key, username, password):
-    temp_list = []
+    return temp_list
 
+# Get Quick Reports from Server, with a batch_size above 1 the services are queried in multi-resource batches
+# Services already in the run journal are skipped. The usage rows are yielded in listing order as they arrive.
+# With a limiter the concurrency adapts to the site between its floor and ceiling instead of staying at max_workers.
+# Services that fail are counted in failures.
+def iter_quick_reports(admin_url, key, username, password, max_workers=DEFAULT_MAX_WORKERS, batch_size=1, journal=None, limiter=None, failures=None):
     # Create a Server instance (stand-alone/unfederated ArcGIS Server site)
-    server = Server(admin_url, username=username, password=password)
-
-    directories = server.services.folders
-    dir_ignore = ['System', 'Utilities', r'/']
-
-    for dir in directories:
-        if dir not in dir_ignore:
-            try:
-                for service in server.services.list(folder=dir):
-                    temp_dict = collections.OrderedDict()
-                    query = fr'services/{dir}/{service.properties.serviceName}.{service.properties.type}'
-                    data = server.usage.quick_report(since="LAST_YEAR", queries=query, metrics="RequestCount")
-                    temp_dict['Site'] = key
-                    temp_dict['Directory'] = 'Root' if dir == r'/' else dir
-                    temp_dict['Service'] = service.properties.serviceName
-                    temp_dict['Service_Type'] = service.properties.type
-                    temp_dict['Time_Slice'] = pd.to_datetime(data['report']['time-slices'], unit='ms').strftime('%Y-%m-%d')
-                    temp_dict['Request_Count'] = data['report']['report-data'][0][0]['data']
-                    temp_list.append(temp_dict)
-                    print(fr'{key}: {query} quick report generated...')
-
-            except Exception as e:
-                print(e)
+    server = Authenticate_ArcGISServer.get_server(admin_url, username, password)
 
-    return temp_list
+    if batch_size > 1:
+        batch_usage = journaled_batches(journal, admin_url, functools.partial(get_batch_usage, server, key), usage_key)
+        yield from crawl_service_batches(server, batch_usage, batch_size, max_workers, limiter=limiter, failures=failures)
+        return
+
+    # Crawl the services in each directory concurrently
+    service_usage = journaled(journal, admin_url, functools.partial(get_service_usage, server, key))
+    yield from crawl_services(server, service_usage, max_workers, limiter=limiter, failures=failures)
+
+def get_quick_reports(admin_url, key, username, password, max_workers=DEFAULT_MAX_WORKERS, batch_size=1, journal=None, limiter=None, failures=None):
+    return list(iter_quick_reports(admin_url, key, username, password, max_workers, batch_size, journal, limiter, failures))
+
+# Write usage rows to a CSV, one row per time slice
+def write_usage_rows(rows, outfile, append=False):
+    with CsvWriter(outfile, COLUMNS, explode=EXPLODE_COLUMNS, append=append, formatters={'Time_Slice': format_time_slices}) as writer:
+        writer.write_rows(rows)
+        return writer.rows_written
 
 # CLICK cmds
 @click.command()
+@Instrument_ArcGISServer.instrumented
 @click.option('--out_dir', type=click.Path(exists=True), default=None, help='Output directory for the CSV file.')
 @click.option('--out_name', default=None, help='Output filename for the CSV file. Please specify extension')
 @click.option('--gis_sites_json', type=click.Path(exists=True), default=None, help='Path to the JSON file containing GIS site data.')
 @click.option('--server_type', type=click.Choice(['map', 'image']), default='map', help='Choose between ArcGIS or ArcGIS ImageServer.')
-
-def main(out_dir, out_name, gis_sites_json, server_type):
+@click.option('--max_workers', type=int, default=None, help='Most concurrent requests per site, the crawl adapts between min_workers and this. Overrides max_workers in the JSON file.')
+@click.option('--batch_size', type=click.IntRange(min=1), default=1, help='Number of services to request in each quick report. Defaults to one report per service.')
+@click.option('--parquet_dir', type=click.Path(), default=None, help='Also merge the usage into the partitioned Parquet usage store in this directory.')
+@click.option('--rollup_dir', type=click.Path(), default=None, help='Also update the usage rollups in this directory. Requires --parquet_dir.')
+@click.option('--max_sites', type=int, default=DEFAULT_MAX_SITES, help='Number of sites to crawl at the same time.')
+@click.option('--journal', 'journal_path', type=click.Path(), default=None, help='Run journal for checkpointing. Defaults to a .journal file in the output directory.')
+@click.option('--resume', is_flag=True, default=False, help='Carry on from the run journal of a run that did not complete.')
+
+def main(out_dir, out_name, gis_sites_json, server_type, max_workers, batch_size, parquet_dir, rollup_dir, max_sites, journal_path, resume):
     default_dir = r"..."
     out_dir = out_dir if out_dir else default_dir
 
@@ -72,20 +154,61 @@ def main(out_dir, out_name, gis_sites_json, server_type):
     # Select the correct server type: ArcGIS Servers or ArcGIS Image Servers
     selected_servers = server_data['arcgis_servers'] if server_type == 'map' else server_data['arcgis_image_servers']
 
-    service_usage_list = []
+    # Checkpoint finished services so a failed run can be resumed
+    journal_path = journal_path if journal_path else os.path.join(out_dir, f"GIS_Services_{server_type}_Usage.journal")
+    journal = RunJournal(journal_path, resume)
+    incomplete_sites = []
 
+    # The quick reports are requested through a Server login, which needs the credentials even when a token is cached
     username, password = Authenticate_ArcGISServer.get_creds()
 
-    for site, server_info in selected_servers.items():
+    # Each site streams its usage to its own part file as the reports arrive
+    def site_usage(site, server_info):
         admin_url = server_info['admin']
-        service_usage_list.extend(get_quick_reports(admin_url, site, username, password))
-
-    # Create DataFrame and output to screen for review
-    df = pd.DataFrame(service_usage_list)
-    df1 = df.explode(['Time_Slice', 'Request_Count']).reset_index(drop=True)
-    df1.to_csv(outfile, index=False)
-    print(f'\nCSV saved as: {outfile}')
-
+        limiter = site_limiter(site, server_info, max_workers)
+        part_file = f"{outfile}.{site}.part"
+        failures = CrawlFailures()
+        try:
+            write_usage_rows(iter_quick_reports(admin_url, site, username, password, limiter.max_workers, batch_size, journal, limiter, failures), part_file)
+        except Exception:
+            # Don't leave a partial part file behind for a failed site, it isn't there when the first request failed
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            raise
+
+        # A token expiry or dropped connection part way fails the rest of the services, keep the journal to resume them
+        if failures.count:
+            print(f"\n{site}: {failures.count} service(s) or directories failed, run again with --resume to fetch them")
+            incomplete_sites.append(site)
+        return part_file
+
+    # Crawl the sites in parallel, the part files are merged in config order
+    part_files = []
+    for site, part_file in run_sites(selected_servers, site_usage, max_sites):
+        if part_file is None:
+            incomplete_sites.append(site)
+        part_files.append(part_file)
+
+    # The Parquet partitions are per site, so each site's usage is merged into the store on its own
+    if parquet_dir:
+        partitions = []
+        for part_file in part_files:
+            if part_file and os.path.exists(part_file):
+                partitions += write_usage(pd.read_csv(part_file), parquet_dir)
+
+        # Only the buckets of the partitions written by this run are rebuilt
+        if rollup_dir and partitions:
+            with Instrument_ArcGISServer.span('rollup', rollup_dir, partitions=len(partitions)):
+                update_rollups(parquet_dir, rollup_dir, partitions)
+
+    with Instrument_ArcGISServer.span('output', outfile):
+        if merge_part_files(part_files, outfile):
+            print(f'\nCSV saved as: {outfile}')
+        else:
+            print("\nNo usage retrieved. CSV file not saved.")
+
+    # The journal is only kept when a site failed or has unfinished services, so it can be resumed
+    journal.close(not incomplete_sites)
     print("\nScript complete.")
 
 if __name__ == '__main__':
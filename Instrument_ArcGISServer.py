@@ -0,0 +1,157 @@
+'''
+This script is the instrumentation layer for the ArcGIS Server scripts. It records timed spans per site, folder, service,
+token request, output step and HTTP call (count, failures, latency histogram, bytes and retries), can write every span
+as a JSON line to a log file, prints an end-of-run summary and can wrap a run in cProfile.
+Use with conjunction in other scripts.
+
+The scripts get two options from the instrumented decorator:
+
+    --log_json "C:\...\run_log.jsonl"    write a JSON line per span
+    --profile "C:\...\run.prof"          run under cProfile and dump the stats (view with python -m pstats run.prof)
+
+The profile covers the worker threads the crawl runs in as well as the main thread.
+
+Requirements: Python 3+
+'''
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import click
+
+HISTOGRAM_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]  # upper bounds in seconds, slower spans go in the last bucket
+
+_stats = {}
+_log = {'file': None}
+_lock = threading.Lock()
+
+# Start a new run, optionally logging each span as a JSON line to log_path
+def configure(log_path=None):
+    with _lock:
+        _stats.clear()
+        if _log['file']:
+            _log['file'].close()
+        _log['file'] = open(log_path, 'a', encoding='utf-8') if log_path else None
+
+def close():
+    with _lock:
+        if _log['file']:
+            _log['file'].close()
+            _log['file'] = None
+
+# Add a finished span to the stats for its kind and the JSON lines log
+def record(kind, name, seconds, failed=False, bytes=0, retries=0, **fields):
+    bucket = next((index for index, bound in enumerate(HISTOGRAM_BUCKETS) if seconds <= bound), len(HISTOGRAM_BUCKETS))
+    with _lock:
+        kind_stats = _stats.setdefault(kind, {
+            'count': 0, 'failures': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+            'bytes': 0, 'retries': 0, 'histogram': [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        })
+        kind_stats['count'] += 1
+        kind_stats['failures'] += 1 if failed else 0
+        kind_stats['total_seconds'] += seconds
+        kind_stats['max_seconds'] = max(kind_stats['max_seconds'], seconds)
+        kind_stats['bytes'] += bytes
+        kind_stats['retries'] += retries
+        kind_stats['histogram'][bucket] += 1
+
+        if _log['file']:
+            event = {'time': datetime.now().isoformat(timespec='milliseconds'), 'kind': kind, 'name': name,
+                     'seconds': round(seconds, 4), 'failed': failed}
+            if bytes:
+                event['bytes'] = bytes
+            if retries:
+                event['retries'] = retries
+            event.update(fields)
+            _log['file'].write(json.dumps(event, default=str) + '\n')
+
+# Time a block of work as a span, a block that raises is recorded as failed
+@contextmanager
+def span(kind, name, **fields):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        record(kind, name, time.perf_counter() - start, failed=True, **fields)
+        raise
+    record(kind, name, time.perf_counter() - start, **fields)
+
+# Get a copy of the stats per span kind
+def get_stats():
+    with _lock:
+        return {kind: dict(kind_stats, histogram=list(kind_stats['histogram'])) for kind, kind_stats in _stats.items()}
+
+# Print the count, failures, timings and latency histogram for each span kind
+def print_summary():
+    stats = get_stats()
+    if not stats:
+        return
+
+    labels = [f"<={bound}s" for bound in HISTOGRAM_BUCKETS] + [f">{HISTOGRAM_BUCKETS[-1]}s"]
+    print("\nRun summary:")
+    for kind, kind_stats in stats.items():
+        mean = kind_stats['total_seconds'] / kind_stats['count']
+        print(f"  {kind}: {kind_stats['count']} ({kind_stats['failures']} failed), total {kind_stats['total_seconds']:.1f}s, "
+              f"mean {mean:.3f}s, max {kind_stats['max_seconds']:.2f}s, {kind_stats['bytes'] / 1e6:.1f} MB, {kind_stats['retries']} retries")
+        histogram = ', '.join(f"{label}: {count}" for label, count in zip(labels, kind_stats['histogram']) if count)
+        print(f"    {histogram}")
+
+# cProfile for a whole run including its worker threads. Before Python 3.12 a profiler only sees the thread that enabled
+# it, so every thread started during the run gets its own and they are merged into one pstats.Stats at the end.
+# From 3.12 one profiler sees every thread (and only one can be enabled at a time).
+class RunProfiler:
+    def __init__(self):
+        self._profilers = []
+        self._lock = threading.Lock()
+
+    # Installed with threading.setprofile, so it is called once at the start of each new thread
+    def _profile_thread(self, frame, event, arg):
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def runcall(self, func, *args, **kwargs):
+        profiler = cProfile.Profile()
+        self._profilers.append(profiler)
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_thread)
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            threading.setprofile(None)
+
+    # The stats of every thread, threads still running are included up to now
+    def stats(self):
+        with self._lock:
+            return pstats.Stats(*self._profilers)
+
+# Decorator for a script's click main, adds the --log_json and --profile options and prints the summary at the end
+def instrumented(main):
+    @click.option('--log_json', type=click.Path(), default=None, help='Write a JSON line per timed span to this file.')
+    @click.option('--profile', type=click.Path(), default=None, help='Run under cProfile and dump the stats to this file.')
+    @functools.wraps(main)
+    def wrapper(*args, log_json=None, profile=None, **kwargs):
+        configure(log_json)
+        profiler = RunProfiler() if profile else None
+        try:
+            with span('run', os.path.basename(sys.argv[0])):
+                if profiler:
+                    return profiler.runcall(main, *args, **kwargs)
+                return main(*args, **kwargs)
+        finally:
+            print_summary()
+            close()
+            if profiler:
+                stats = profiler.stats()
+                stats.dump_stats(profile)
+                print(f"\nProfile saved to {profile}, the slowest calls were:")
+                stats.sort_stats('cumulative').print_stats(15)
+
+    return wrapper
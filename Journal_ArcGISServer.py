@@ -0,0 +1,106 @@
+'''
+This script is the run journal for long crawls. Every per-service result is appended to a JSON lines journal as soon as
+it finishes, so a run that dies part way (token expiry, VPN drop, server restart) can be started again with --resume
+and only the services that are not in the journal are fetched again. The journal is removed once a run completes.
+Use with conjunction in other scripts.
+
+Unlike the state store, which keeps results between runs for services that haven't changed, the journal only covers
+the current run.
+
+Requirements: Python 3+
+'''
+import json
+import os
+import threading
+
+# Key for a service in the journal
+def service_key(dir, service):
+    return f"{dir}/{service.properties.serviceName}.{service.properties.type}"
+
+class RunJournal:
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = {}
+
+        # Load the results of the run being resumed, a line cut off by the crash is skipped
+        if resume and not os.path.exists(path):
+            print(f"Warning: no run journal at '{path}' to resume from, every service will be fetched again")
+        elif resume:
+            with open(path, 'r', encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._done[(entry['site'], entry['key'])] = entry['data']
+            print(f"Resuming from '{path}', {len(self._done)} services already done")
+
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    # Get the journaled result for a service, None when it isn't done yet
+    def get(self, site, key):
+        with self._lock:
+            return self._done.get((site, key))
+
+    # Append a finished result to the journal, it is flushed straight away so it survives a crash
+    def record(self, site, key, data):
+        line = json.dumps({'site': site, 'key': key, 'data': data}, default=list)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    # Close the journal, it is removed when the run completed
+    def close(self, completed=False):
+        with self._lock:
+            self._file.close()
+            if completed:
+                os.remove(self.path)
+        if not completed:
+            print(f"Run journal kept at '{self.path}', run again with --resume to carry on")
+
+# Wrap a per-service crawl function so finished services are journaled and skipped when the run is resumed.
+# Returns func unchanged when there is no journal.
+def journaled(journal, site, func):
+    if journal is None:
+        return func
+
+    def fetch_pending(dir, service):
+        key = service_key(dir, service)
+        data = journal.get(site, key)
+        if data is not None:
+            return data
+
+        data = func(dir, service)
+        if data is not None:
+            journal.record(site, key, data)
+        return data
+
+    return fetch_pending
+
+# Wrap a batch crawl function the same way, result_key(result) gives the service key of each result in a batch
+def journaled_batches(journal, site, func, result_key):
+    if journal is None:
+        return func
+
+    def fetch_pending(batch):
+        results = {}
+        pending = []
+        for dir, service in batch:
+            key = service_key(dir, service)
+            data = journal.get(site, key)
+            if data is None:
+                pending.append((dir, service))
+            else:
+                results[key] = data
+
+        for data in func(pending) if pending else []:
+            key = result_key(data)
+            journal.record(site, key, data)
+            results[key] = data
+
+        # Keep the listing order of the batch
+        keys = [service_key(dir, service) for dir, service in batch]
+        return [results[key] for key in keys if key in results]
+
+    return fetch_pending
@@ -0,0 +1,203 @@
+'''
+This script harvests the create date of services from their REST info/metadata XML. The metadata documents are
+requested concurrently with asyncio and httpx, in the slots of the site's adaptive limiter (or at most max_concurrency
+at a time) so the harvest backs off from a site that slows down or fails. Each document is parsed as it arrives and
+parsing stops as soon as Esri/CreaDate is found instead of building the whole tree.
+
+With a state store the ETag and Last-Modified of every metadata document are cached along with its create date, and
+later runs send If-None-Match/If-Modified-Since. An unchanged document comes back as a 304 Not Modified with no body,
+so a create date that hasn't changed costs one empty round trip. Without httpx the documents are requested on a thread
+pool through the shared transport instead, with the same cache and early stop.
+Use with conjunction in other scripts.
+
+Requirements: Python 3+, httpx (optional)
+'''
+import asyncio
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import urlsplit
+import Transport_ArcGISServer  # custom script
+import Instrument_ArcGISServer  # custom script
+from CrawlServices_ArcGISServer import AdaptiveLimiter  # custom script
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+CHUNK_SIZE = 8192  # bytes fed to the parser at a time
+DEFAULT_MAX_CONCURRENCY = 8
+
+# Incremental parser for a metadata document that stops at Esri/CreaDate
+class CreateDateParser:
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._tags = []
+        self.create_date = None
+        self.done = False
+
+    # Parse the next chunk of the document, returns True once the create date is found
+    def feed(self, chunk):
+        if self.done:
+            return True
+        self._parser.feed(chunk)
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                self._tags.append(element.tag)
+                continue
+            if element.tag == 'CreaDate' and self._tags[-2:-1] == ['Esri']:
+                self.create_date = element.text or ''
+                self.done = True
+                return True
+            self._tags.pop()
+        return False
+
+# Conditional request headers for a cached metadata document
+def conditional_headers(cached):
+    if not cached:
+        return {}
+    headers = {'If-Modified-Since': cached['last_modified']}
+    if cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    return headers
+
+# Work out the create date from a metadata response, a fetched document is cached with its validators
+def create_date_from(store, url, cached, status, headers, parser):
+    if status == 304 and cached:
+        return cached['create_date']
+    if status != 200:
+        return ''
+
+    create_date = parser.create_date or ''
+    if store:
+        # Without a Last-Modified header the time of this fetch is sent back as If-Modified-Since
+        store.save_metadata(url, headers.get('ETag'), headers.get('Last-Modified') or formatdate(usegmt=True), create_date)
+    return create_date
+
+def _record(url, seconds, failed, status=None, bytes=0, retries=0):
+    parts = urlsplit(url)
+    Transport_ArcGISServer.record_stats(parts.netloc, seconds, failed)
+    Instrument_ArcGISServer.record('http', f"{parts.netloc}{parts.path}", seconds, failed=failed, method='GET',
+                                   status=status, bytes=bytes, retries=retries)
+
+# Get the create date of a service from its metadata through the shared transport, returns (create_date, failed)
+def _fetch_create_date(url, store=None):
+    cached = store.load_metadata(url) if store else None
+    try:
+        response = Transport_ArcGISServer.get(url, headers=conditional_headers(cached))
+        parser = CreateDateParser()
+        if response.status_code == 200:
+            content = response.content
+            for start in range(0, len(content), CHUNK_SIZE):
+                if parser.feed(content[start:start + CHUNK_SIZE]):
+                    break
+        return create_date_from(store, url, cached, response.status_code, response.headers, parser), response.status_code >= 400
+    except Exception:
+        return '', True
+
+# Function to get the create date of a service from its metadata through the shared transport, in a slot of the
+# limiter when there is one
+def fetch_create_date(url, store=None, limiter=None):
+    if limiter is None:
+        return _fetch_create_date(url, store)[0]
+
+    generation = limiter.acquire()
+    start = time.perf_counter()
+    create_date, failed = '', True
+    try:
+        create_date, failed = _fetch_create_date(url, store)
+    finally:
+        limiter.release(generation, time.perf_counter() - start, failed)
+    return create_date
+
+# Timeout for the async client from the transport settings, which can be one number or (connect, read)
+def client_timeout():
+    timeout = Transport_ArcGISServer.settings['timeout']
+    connect, read = timeout if isinstance(timeout, (tuple, list)) else (timeout, timeout)
+    return httpx.Timeout(read, connect=connect)
+
+# Get the create date of a service from its metadata with the async client, returns (create_date, failed)
+async def _fetch_create_date_async(client, url, store=None):
+    cached = store.load_metadata(url) if store else None
+    retries = Transport_ArcGISServer.settings['retries']
+    backoff = Transport_ArcGISServer.settings['backoff']
+
+    start = time.perf_counter()
+    status = None
+    size = 0
+    attempt = 0
+    try:
+        while True:
+            async with client.stream('GET', url, headers=conditional_headers(cached)) as response:
+                status = response.status_code
+                if status in Transport_ArcGISServer.RETRY_STATUS and attempt < retries:
+                    attempt += 1
+                    await asyncio.sleep(backoff * 2 ** (attempt - 1))
+                    continue
+
+                parser = CreateDateParser()
+                if status == 200:
+                    # The rest of the document is still read once the create date is found, but not parsed,
+                    # so the connection goes back to the pool
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        size += len(chunk)
+                        parser.feed(chunk)
+                break
+    except Exception:
+        _record(url, time.perf_counter() - start, True, status, size, attempt)
+        return '', True
+
+    failed = status >= 400
+    _record(url, time.perf_counter() - start, failed, status, size, attempt)
+    try:
+        return create_date_from(store, url, cached, status, response.headers, parser), failed
+    except Exception:
+        return '', True
+
+# Function to get the create date of a service from its metadata with the async client, in a slot of the limiter.
+# The harvest runs after the crawl, so its requests are the only ones using the limiter and the slots they free are
+# announced on the condition.
+async def fetch_create_date_async(client, limiter, condition, url, store=None):
+    async with condition:
+        generation = limiter.try_acquire()
+        while generation is None:
+            await condition.wait()
+            generation = limiter.try_acquire()
+
+    start = time.perf_counter()
+    create_date, failed = '', True
+    try:
+        create_date, failed = await _fetch_create_date_async(client, url, store)
+    finally:
+        limiter.release(generation, time.perf_counter() - start, failed)
+        async with condition:
+            condition.notify_all()
+    return create_date
+
+async def _harvest_async(urls, store, limiter):
+    condition = asyncio.Condition()
+    limits = httpx.Limits(max_connections=limiter.max_workers, max_keepalive_connections=limiter.max_workers)
+    async with httpx.AsyncClient(timeout=client_timeout(), limits=limits) as client:
+        return await asyncio.gather(*(fetch_create_date_async(client, limiter, condition, url, store) for url in urls))
+
+# Get the create dates for a list of metadata urls, in the same order. Failed requests give ''.
+# With a site limiter the requests run in its slots and their latency and failures adjust it, otherwise at most
+# max_concurrency are sent at a time.
+def harvest_create_dates(urls, store=None, max_concurrency=DEFAULT_MAX_CONCURRENCY, limiter=None):
+    urls = list(urls)
+    if not urls:
+        return []
+
+    if limiter is None:
+        limiter = AdaptiveLimiter(max_concurrency, max_concurrency)
+    else:
+        # The metadata requests take a different time to whatever the limiter was timing before
+        limiter.reset_baseline()
+
+    if httpx is None:
+        with ThreadPoolExecutor(max_workers=limiter.max_workers) as executor:
+            return list(executor.map(lambda url: fetch_create_date(url, store, limiter), urls))
+
+    return asyncio.run(_harvest_async(urls, store, limiter))
@@ -0,0 +1,338 @@
+'''
+This script is the snapshot store for the service details catalogue. Each crawl is saved as a snapshot in a SQLite
+database instead of only as a dated CSV, so any two runs can be compared without loading and joining whole CSVs.
+
+Every service row is hashed on its content and stored once however many snapshots it is in, a snapshot only keeps the
+hash of each of its services. The services are also hashed per folder and the folders per snapshot, so a diff skips
+every folder whose hash is the same in both snapshots and only looks at the services in the folders that changed:
+
+    added      - services only in the new snapshot
+    removed    - services only in the old snapshot
+    changed    - services in both with a different row, with the fields that changed
+
+GetServiceDetails_ArcGISServer.py saves a snapshot after each run with --snapshot_db, older CSVs can be saved with
+--save. Can also be run in cmd line with the following:
+
+    SnapshotStore_ArcGISServer.py --snapshot_db "C:\...\snapshots.db" --save "C:\...\GIS_Services_map_20240101.csv" --server_type "map"
+    SnapshotStore_ArcGISServer.py --snapshot_db "C:\...\snapshots.db" --list
+    SnapshotStore_ArcGISServer.py --snapshot_db "C:\...\snapshots.db" --diff "GIS_Services_map_20240101" "GIS_Services_map_20240201" --out_csv "C:\...\changes.csv"
+
+Snapshots are ordered by the date of the run they were taken from. A crawl is dated when it is saved, a saved CSV by
+the date in its file name (e.g. _20240101 or _20240101_093000), else by --run_date or the time the file was modified.
+Without --diff the latest two runs of the server type are compared. --diff takes snapshot names, or ids with --by_id.
+
+Requirements: Python 3+
+'''
+import csv
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+import click
+from CsvWriter_ArcGISServer import CsvWriter  # custom script
+import Instrument_ArcGISServer  # custom script
+
+# Columns that identify a service in a details row, the rest of the row is its content
+KEY_COLUMNS = ['Site', 'Directory', 'Service_Name', 'Service_Type']
+DIFF_COLUMNS = ['Change', 'Site', 'Directory', 'Service_Name', 'Service_Type', 'Field', 'Old_Value', 'New_Value']
+BATCH_SIZE = 1000  # service rows stored at a time
+RUN_DATE = re.compile(r'(\d{8})(?:_(\d{6}))?')  # date (and time) of a run in an output file name
+
+# Values as text, so a row hashes the same whether it came from a crawl or was read back from a CSV
+def normalise_row(row):
+    values = {}
+    for column, value in row.items():
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            value = ''
+        values[column] = str(value)
+    return values
+
+def content_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def service_key(row):
+    return f"{row['Site']}/{row['Directory']}/{row['Service_Name']}.{row['Service_Type']}"
+
+def folder_key(row):
+    return f"{row['Site']}/{row['Directory']}"
+
+# Hash of a set of {key: hash}, the same for the same entries in any order
+def combined_hash(hashes):
+    return content_hash('\n'.join(f"{key}:{value}" for key, value in sorted(hashes.items())))
+
+class SnapshotStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                server_type TEXT NOT NULL,
+                taken TEXT NOT NULL,
+                run_date TEXT NOT NULL,
+                services INTEGER NOT NULL,
+                hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS service_rows (
+                hash TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS snapshot_folders (
+                snapshot_id INTEGER NOT NULL,
+                folder TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (snapshot_id, folder)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS snapshot_services (
+                snapshot_id INTEGER NOT NULL,
+                folder TEXT NOT NULL,
+                service TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (snapshot_id, folder, service)
+            ) WITHOUT ROWID;
+        ''')
+        # Stores from before snapshots had a run date are dated by when they were saved
+        if 'run_date' not in [column[1] for column in self._conn.execute('PRAGMA table_info(snapshots)')]:
+            self._conn.execute('ALTER TABLE snapshots ADD COLUMN run_date TEXT')
+            self._conn.execute('UPDATE snapshots SET run_date = taken')
+        self._conn.commit()
+
+    # Save the details rows of a crawl as a snapshot, a snapshot with the same name is replaced. Returns its id.
+    # The rows can be any iterable (e.g. read from a CSV), only their hashes are held and the row data is stored in batches.
+    # run_date is when the crawl ran as an ISO datetime, defaults to now.
+    def save(self, name, server_type, rows, run_date=None):
+        taken = datetime.now().isoformat(timespec='seconds')
+        with self._lock:
+            self._delete(name)
+            cursor = self._conn.execute(
+                'INSERT INTO snapshots (name, server_type, taken, run_date, services, hash) VALUES (?, ?, ?, ?, 0, ?)',
+                (name, server_type, taken, run_date or taken, '')
+            )
+            snapshot_id = cursor.lastrowid
+
+            services = {}
+            rows_by_hash = {}
+            for row in rows:
+                row = normalise_row(row)
+                data = json.dumps(row, sort_keys=True)
+                row_hash = content_hash(data)
+                rows_by_hash[row_hash] = data
+                services[(folder_key(row), service_key(row))] = row_hash
+                if len(rows_by_hash) >= BATCH_SIZE:
+                    self._save_rows(rows_by_hash)
+                    rows_by_hash = {}
+            self._save_rows(rows_by_hash)
+
+            folders = {}
+            for (folder, service), row_hash in services.items():
+                folders.setdefault(folder, {})[service] = row_hash
+            folder_hashes = {folder: combined_hash(folder_services) for folder, folder_services in folders.items()}
+
+            self._conn.executemany('INSERT INTO snapshot_folders VALUES (?, ?, ?)',
+                                   [(snapshot_id, folder, folder_hash) for folder, folder_hash in folder_hashes.items()])
+            self._conn.executemany('INSERT INTO snapshot_services VALUES (?, ?, ?, ?)',
+                                   [(snapshot_id, folder, service, row_hash) for (folder, service), row_hash in services.items()])
+            self._conn.execute('UPDATE snapshots SET services = ?, hash = ? WHERE id = ?',
+                               (len(services), combined_hash(folder_hashes), snapshot_id))
+            self._conn.commit()
+        return snapshot_id
+
+    # Called with the lock held, rows that are already stored for an earlier snapshot are kept as they are
+    def _save_rows(self, rows_by_hash):
+        self._conn.executemany('INSERT OR IGNORE INTO service_rows VALUES (?, ?)', rows_by_hash.items())
+
+    # Called with the lock held, rows no other snapshot uses are left for prune
+    def _delete(self, name):
+        row = self._conn.execute('SELECT id FROM snapshots WHERE name = ?', (name,)).fetchone()
+        if row:
+            for table in ('snapshot_services', 'snapshot_folders'):
+                self._conn.execute(f'DELETE FROM {table} WHERE snapshot_id = ?', (row[0],))
+            self._conn.execute('DELETE FROM snapshots WHERE id = ?', (row[0],))
+
+    # Remove the stored rows that are no longer in any snapshot
+    def prune(self):
+        with self._lock:
+            deleted = self._conn.execute(
+                'DELETE FROM service_rows WHERE hash NOT IN (SELECT hash FROM snapshot_services)'
+            ).rowcount
+            self._conn.commit()
+        return deleted
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    # The snapshots in the order of the runs they were taken from
+    def list_snapshots(self, server_type=None):
+        if server_type:
+            return self._query('SELECT * FROM snapshots WHERE server_type = ? ORDER BY run_date, id', (server_type,))
+        return self._query('SELECT * FROM snapshots ORDER BY run_date, id')
+
+    # Find a snapshot by its name, None when there isn't one
+    def get_snapshot(self, name):
+        rows = self._query('SELECT * FROM snapshots WHERE name = ?', (name,))
+        return rows[0] if rows else None
+
+    # Find a snapshot by its id, None when there isn't one
+    def get_snapshot_id(self, snapshot_id):
+        rows = self._query('SELECT * FROM snapshots WHERE id = ?', (snapshot_id,))
+        return rows[0] if rows else None
+
+    def _folder_hashes(self, snapshot_id):
+        return {row['folder']: row['hash'] for row in self._query(
+            'SELECT folder, hash FROM snapshot_folders WHERE snapshot_id = ?', (snapshot_id,)
+        )}
+
+    def _service_hashes(self, snapshot_id, folders):
+        hashes = {}
+        for folder in folders:
+            for row in self._query('SELECT service, hash FROM snapshot_services WHERE snapshot_id = ? AND folder = ?',
+                                   (snapshot_id, folder)):
+                hashes[row['service']] = row['hash']
+        return hashes
+
+    def _rows(self, hashes):
+        rows = {}
+        for row_hash in set(hashes):
+            row = self._query('SELECT data FROM service_rows WHERE hash = ?', (row_hash,))
+            rows[row_hash] = json.loads(row[0]['data'])
+        return rows
+
+    # Compare two snapshots, returns the diff rows in DIFF_COLUMNS (one per changed field for a changed service)
+    def diff(self, old, new):
+        if old['hash'] == new['hash']:
+            return []
+
+        # Only the folders whose hash differs are looked at
+        old_folders = self._folder_hashes(old['id'])
+        new_folders = self._folder_hashes(new['id'])
+        folders = [folder for folder in sorted(set(old_folders) | set(new_folders)) if old_folders.get(folder) != new_folders.get(folder)]
+
+        old_services = self._service_hashes(old['id'], folders)
+        new_services = self._service_hashes(new['id'], folders)
+        changes = [(service, old_services.get(service), new_services.get(service))
+                   for service in sorted(set(old_services) | set(new_services))
+                   if old_services.get(service) != new_services.get(service)]
+        rows = self._rows([row_hash for _, old_hash, new_hash in changes for row_hash in (old_hash, new_hash) if row_hash])
+
+        diff_rows = []
+        for service, old_hash, new_hash in changes:
+            if old_hash is None:
+                diff_rows.append(dict({column: rows[new_hash][column] for column in KEY_COLUMNS}, Change='added'))
+            elif new_hash is None:
+                diff_rows.append(dict({column: rows[old_hash][column] for column in KEY_COLUMNS}, Change='removed'))
+            else:
+                old_row, new_row = rows[old_hash], rows[new_hash]
+                for field in sorted(set(old_row) | set(new_row)):
+                    if old_row.get(field) != new_row.get(field):
+                        diff_rows.append(dict({column: new_row[column] for column in KEY_COLUMNS}, Change='changed',
+                                              Field=field, Old_Value=old_row.get(field), New_Value=new_row.get(field)))
+        return diff_rows
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+# Open the store at a path, or return None when no path is given
+def open_snapshots(path):
+    return SnapshotStore(path) if path else None
+
+# Read the rows of a service details CSV one at a time, the values are kept as text with empty fields as ''
+def read_csv_rows(path):
+    with open(path, 'r', newline='', encoding='utf-8') as csv_file:
+        yield from csv.DictReader(csv_file)
+
+# Run date of a saved CSV from the date in its file name, else the given run date or the time the file was modified
+def csv_run_date(path, run_date=None):
+    match = RUN_DATE.search(os.path.basename(path))
+    if match:
+        try:
+            return datetime.strptime(''.join(match.groups('000000')), '%Y%m%d%H%M%S').isoformat(timespec='seconds')
+        except ValueError:
+            pass  # digits in the name that aren't a date
+    if run_date:
+        return run_date.isoformat(timespec='seconds')
+    return datetime.fromtimestamp(os.path.getmtime(path)).isoformat(timespec='seconds')
+
+# CLICK cmds
+@click.command()
+@Instrument_ArcGISServer.instrumented
+@click.option('--snapshot_db', type=click.Path(), default=None, help='SQLite snapshot store.')
+@click.option('--save', 'save_csv', type=click.Path(exists=True), multiple=True, help='Service details CSV to save as a snapshot named after the file, can be given more than once.')
+@click.option('--server_type', type=click.Choice(['map', 'image']), default='map', help='Server type of the saved CSVs and of the snapshots compared by default.')
+@click.option('--list', 'list_only', is_flag=True, default=False, help='List the snapshots.')
+@click.option('--run_date', type=click.DateTime(), default=None, help='Run date of saved CSVs without a date in their file name. Defaults to when the file was modified.')
+@click.option('--diff', nargs=2, default=None, help='Names of the old and new snapshots to compare. Defaults to the latest two runs.')
+@click.option('--by_id', is_flag=True, default=False, help='The snapshots given to --diff are ids instead of names.')
+@click.option('--out_csv', type=click.Path(), default=None, help='Also save the differences to this CSV.')
+@click.option('--prune', is_flag=True, default=False, help='Remove stored rows that are no longer in any snapshot.')
+
+def main(snapshot_db, save_csv, server_type, run_date, list_only, diff, by_id, out_csv, prune):
+    default_db = r"..."
+    snapshot_db = snapshot_db if snapshot_db else default_db
+
+    store = SnapshotStore(snapshot_db)
+
+    for path in save_csv:
+        name = os.path.splitext(os.path.basename(path))[0]
+        with Instrument_ArcGISServer.span('snapshot', name):
+            store.save(name, server_type, read_csv_rows(path), csv_run_date(path, run_date))
+        click.echo(f"Saved snapshot '{name}' ({store.get_snapshot(name)['services']} services)")
+
+    if prune:
+        click.echo(f"Pruned {store.prune()} stored rows")
+
+    if list_only:
+        for snapshot in store.list_snapshots():
+            click.echo(f"  {snapshot['id']} | {snapshot['name']} | {snapshot['server_type']} | {snapshot['run_date']} | {snapshot['services']} services")
+        store.close()
+        return
+
+    if diff:
+        if by_id:
+            try:
+                old, new = (store.get_snapshot_id(int(snapshot_id)) for snapshot_id in diff)
+            except ValueError:
+                store.close()
+                raise click.BadParameter(f"Snapshot ids must be numbers: {' '.join(diff)}", param_hint='--diff')
+        else:
+            old, new = (store.get_snapshot(name) for name in diff)
+        missing = [name for name, snapshot in zip(diff, (old, new)) if snapshot is None]
+        if missing:
+            store.close()
+            raise click.BadParameter(f"Snapshot not found: {', '.join(missing)}", param_hint='--diff')
+    else:
+        snapshots = store.list_snapshots(server_type)
+        if len(snapshots) < 2:
+            click.echo(f"\nNeed two {server_type} snapshots to compare, found {len(snapshots)}.")
+            store.close()
+            return
+        old, new = snapshots[-2:]
+
+    with Instrument_ArcGISServer.span('diff', f"{old['name']}..{new['name']}"):
+        diff_rows = store.diff(old, new)
+    store.close()
+
+    counts = {change: len({tuple(row[column] for column in KEY_COLUMNS) for row in diff_rows if row['Change'] == change})
+              for change in ('added', 'removed', 'changed')}
+    click.echo(f"\n{old['name']} -> {new['name']}: {counts['added']} added, {counts['removed']} removed, {counts['changed']} changed")
+    for row in diff_rows:
+        detail = f" {row['Field']}: '{row['Old_Value']}' -> '{row['New_Value']}'" if row['Change'] == 'changed' else ''
+        click.echo(f"  {row['Change']:8} {row['Site']}/{row['Directory']}/{row['Service_Name']}.{row['Service_Type']}{detail}")
+
+    if out_csv:
+        with CsvWriter(out_csv, DIFF_COLUMNS) as writer:
+            writer.write_rows(diff_rows)
+        click.echo(f"\nCSV saved as: {out_csv}")
+
+if __name__ == '__main__':
+    main()
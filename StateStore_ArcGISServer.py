@@ -0,0 +1,132 @@
+'''
+This script is the local state store for incremental service inventories. It keeps the last fetched metadata/manifest
+results for every service in a SQLite database keyed by site, folder and service, along with a fingerprint of the
+service configuration from the admin listing. Later runs only re-fetch services that were added or whose configuration
+changed, unchanged services are served from the store.
+The store also caches the ETag/Last-Modified and create date of the service metadata documents, so they can be
+requested again with conditional requests (see MetadataHarvest_ArcGISServer.py).
+Use with conjunction in other scripts.
+
+Requirements: Python 3+
+'''
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+COMMIT_EVERY = 100  # saved results between commits
+
+# Fingerprint a service from its admin configuration
+def service_fingerprint(service):
+    config = json.dumps(service.properties, sort_keys=True, default=lambda o: getattr(o, '_mapping', str(o)))
+    return hashlib.sha1(config.encode()).hexdigest()
+
+class StateStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS service_state (
+                site TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                service TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated TEXT NOT NULL,
+                PRIMARY KEY (site, folder, service, kind)
+            )''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS metadata_cache (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT NOT NULL,
+                create_date TEXT NOT NULL,
+                updated TEXT NOT NULL
+            )''')
+        self._conn.commit()
+
+    # Commit every COMMIT_EVERY saves, called with the lock held
+    def _saved(self):
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self._conn.commit()
+            self._pending = 0
+
+    # Get the stored result for a service, None when it is new or its fingerprint changed
+    def load(self, site, folder, service, kind, fingerprint):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT fingerprint, data FROM service_state WHERE site = ? AND folder = ? AND service = ? AND kind = ?',
+                (site, folder, service, kind)
+            ).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        return json.loads(row[1])
+
+    # Store the result for a service
+    def save(self, site, folder, service, kind, fingerprint, data):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO service_state VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (site, folder, service, kind, fingerprint, json.dumps(data), datetime.now().isoformat(timespec='seconds'))
+            )
+            self._saved()
+
+    # Replace the stored result for a service that was finished after it was saved, its fingerprint is kept
+    def update(self, site, folder, service, kind, data):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE service_state SET data = ?, updated = ? WHERE site = ? AND folder = ? AND service = ? AND kind = ?',
+                (json.dumps(data), datetime.now().isoformat(timespec='seconds'), site, folder, service, kind)
+            )
+            self._saved()
+
+    # Get the cached validators and create date for a metadata url, None when it was never fetched
+    def load_metadata(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT etag, last_modified, create_date FROM metadata_cache WHERE url = ?', (url,)
+            ).fetchone()
+        return dict(zip(('etag', 'last_modified', 'create_date'), row)) if row else None
+
+    # Store the validators and create date for a metadata url
+    def save_metadata(self, url, etag, last_modified, create_date):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO metadata_cache VALUES (?, ?, ?, ?, ?)',
+                (url, etag, last_modified, create_date, datetime.now().isoformat(timespec='seconds'))
+            )
+            self._saved()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+# Wrap a per-service crawl function so unchanged services are served from the store.
+# Returns func unchanged when there is no store.
+def incremental(store, site, kind, func):
+    if store is None:
+        return func
+
+    def fetch_changed(dir, service):
+        name = f"{service.properties.serviceName}.{service.properties.type}"
+        fingerprint = service_fingerprint(service)
+        data = store.load(site, dir, name, kind, fingerprint)
+        if data is not None:
+            return data
+
+        data = func(dir, service)
+        if data is not None:
+            store.save(site, dir, name, kind, fingerprint, data)
+        return data
+
+    return fetch_changed
+
+# Open the store at a path, or return None when no path is given
+def open_store(path):
+    return StateStore(path) if path else None
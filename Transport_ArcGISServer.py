@@ -0,0 +1,115 @@
+'''
+This script is the shared HTTP transport for the ArcGIS Server scripts. It keeps one pooled requests.Session per host so
+repeated calls reuse keep-alive connections instead of opening a new TLS connection each time, applies a default timeout
+so a slow service can't hang a run, retries with exponential backoff on 429 and 5xx responses and records request
+counts and latencies per host. Every request is also recorded as an 'http' span in Instrument_ArcGISServer.py.
+Use with conjunction in other scripts.
+
+Requirements: Python 3+
+'''
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import Instrument_ArcGISServer  # custom script
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_TIMEOUT = (10, 120)  # seconds to connect, seconds to wait for a response
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5  # sleeps 0.5, 1, 2... seconds between retries
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+settings = {
+    'pool_size': DEFAULT_POOL_SIZE,
+    'timeout': DEFAULT_TIMEOUT,
+    'retries': DEFAULT_RETRIES,
+    'backoff': DEFAULT_BACKOFF,
+}
+
+_sessions = {}
+_stats = {}
+_lock = threading.Lock()
+
+# Change the transport settings, sessions that already exist are replaced on their next use
+def configure(pool_size=None, timeout=None, retries=None, backoff=None):
+    with _lock:
+        for key, value in (('pool_size', pool_size), ('timeout', timeout), ('retries', retries), ('backoff', backoff)):
+            if value is not None:
+                settings[key] = value
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+# Get the pooled session for the host of a url, creating it on first use
+def get_session(url):
+    host = urlsplit(url).netloc
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            retry = Retry(
+                total=settings['retries'],
+                backoff_factor=settings['backoff'],
+                status_forcelist=RETRY_STATUS,
+                allowed_methods=None,  # generateToken and report queries are POSTs that are safe to repeat
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings['pool_size'], max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+    return session
+
+# Add a finished request to the stats for its host, also used for requests sent outside the pooled sessions
+def record_stats(host, seconds, failed):
+    with _lock:
+        host_stats = _stats.setdefault(host, {'requests': 0, 'failures': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        host_stats['requests'] += 1
+        host_stats['failures'] += 1 if failed else 0
+        host_stats['total_seconds'] += seconds
+        host_stats['max_seconds'] = max(host_stats['max_seconds'], seconds)
+
+# Send a request through the pooled session for its host
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', settings['timeout'])
+    parts = urlsplit(url)
+    host = parts.netloc
+    start = time.perf_counter()
+    try:
+        response = get_session(url).request(method, url, **kwargs)
+    except requests.RequestException as e:
+        seconds = time.perf_counter() - start
+        record_stats(host, seconds, failed=True)
+        Instrument_ArcGISServer.record('http', f"{host}{parts.path}", seconds, failed=True, method=method, error=str(e))
+        raise
+    seconds = time.perf_counter() - start
+    failed = response.status_code >= 400
+    record_stats(host, seconds, failed=failed)
+
+    # The query string is left out of the span name, it can hold a token
+    retries = getattr(response.raw, 'retries', None)
+    Instrument_ArcGISServer.record('http', f"{host}{parts.path}", seconds, failed=failed, method=method,
+                                   status=response.status_code, bytes=len(response.content),
+                                   retries=len(retries.history) if retries else 0)
+    return response
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+# Get a copy of the request stats per host
+def get_stats():
+    with _lock:
+        return {host: dict(host_stats) for host, host_stats in _stats.items()}
+
+# Print the request count and latencies per host
+def print_stats():
+    for host, host_stats in get_stats().items():
+        mean = host_stats['total_seconds'] / host_stats['requests']
+        print(f"{host}: {host_stats['requests']} requests, {host_stats['failures']} failed, "
+              f"mean {mean:.2f}s, max {host_stats['max_seconds']:.2f}s")
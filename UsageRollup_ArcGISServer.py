@@ -0,0 +1,218 @@
+'''
+This script maintains pre-aggregated usage tables for reporting on top of the Parquet usage store, so dashboards read
+small summary tables instead of the full daily history:
+
+    service_{period}.parquet    Request_Count and Active_Days per service for each weekly (Monday) or monthly bucket
+    directory_{period}.parquet  Request_Count, Services and Active_Services per directory for each bucket
+    site_{period}.parquet       the same per site
+    service_activity.parquet    first and last time slice and the last slice with requests for each service
+    zero_traffic.parquet        services with no requests for --zero_days days (or none in the whole history)
+
+Only the buckets touched by new usage are rebuilt. The service rollups are recomputed for the weeks and months of the
+site/month partitions that were written, read from just those partitions, and the directory and site rollups are
+summed from the (small) service rollups. The activity dates only move forward, so a restated report that lowers a
+count doesn't move Last_Request back.
+Can also be run in cmd line with the following:
+
+    UsageRollup_ArcGISServer.py --parquet_dir "C:\directory...\parquet" --rollup_dir "C:\directory...\parquet_rollups" --rebuild --zero_days 90 --out_csv "C:\...\zero_traffic.csv"
+
+GetServiceUsage_ArcGIS_Server.py and CleanQuickReportUsageData.py update the rollups after writing to the Parquet store
+when they are run with --rollup_dir.
+
+Requirements: Python 3+, pandas, pyarrow
+'''
+import os
+import click
+import pandas as pd
+from UsageStore_ArcGISServer import read_usage, CATEGORY_COLUMNS  # custom script
+import Instrument_ArcGISServer  # custom script
+
+SERVICE_COLUMNS = CATEGORY_COLUMNS  # Site, Directory, Service, Service_Type
+LEVELS = {
+    'service': SERVICE_COLUMNS,
+    'directory': ['Site', 'Directory'],
+    'site': ['Site'],
+}
+PERIODS = ['weekly', 'monthly']
+DEFAULT_ZERO_DAYS = 90
+
+def table_path(rollup_root, name):
+    return os.path.join(rollup_root, f"{name}.parquet")
+
+def read_table(rollup_root, name):
+    path = table_path(rollup_root, name)
+    return pd.read_parquet(path) if os.path.exists(path) else None
+
+def write_table(df, rollup_root, name):
+    path = table_path(rollup_root, name)
+    df.to_parquet(f"{path}.tmp", engine='pyarrow', compression='snappy', index=False)
+    os.replace(f"{path}.tmp", path)
+
+# Start of the bucket for each time slice, weeks start on a Monday
+def period_start(time_slices, period):
+    if period == 'weekly':
+        return (time_slices - pd.to_timedelta(time_slices.dt.dayofweek, unit='D')).dt.normalize()
+    return time_slices.dt.to_period('M').dt.to_timestamp()
+
+# The weekly and monthly buckets for a list of (site, YYYY-MM) partitions, as {period: {(site, start), ...}}
+def touched_buckets(partitions):
+    buckets = {period: set() for period in PERIODS}
+    for site, month in partitions:
+        start = pd.Timestamp(f"{month}-01")
+        end = start + pd.offsets.MonthEnd(0)
+        buckets['monthly'].add((site, start))
+        for week in pd.date_range(start - pd.Timedelta(days=start.dayofweek), end, freq='7D'):
+            buckets['weekly'].add((site, week))
+    return buckets
+
+# The (site, YYYY-MM) partitions holding the slices of the buckets, a week can span two months
+def bucket_partitions(buckets):
+    partitions = set()
+    for site, start in buckets['monthly']:
+        partitions.add((site, start.strftime('%Y-%m')))
+    for site, start in buckets['weekly']:
+        partitions.add((site, start.strftime('%Y-%m')))
+        partitions.add((site, (start + pd.Timedelta(days=6)).strftime('%Y-%m')))
+    return partitions
+
+# Read the usage for a set of (site, YYYY-MM) partitions, with the category columns as strings (missing values stay missing)
+def read_partitions(usage_root, partitions):
+    months_by_site = {}
+    for site, month in partitions:
+        months_by_site.setdefault(site, []).append(month)
+
+    parts = [read_usage(usage_root, sites=[site], months=months) for site, months in sorted(months_by_site.items())]
+    parts = [part for part in parts if not part.empty]
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True).astype({column: 'string' for column in SERVICE_COLUMNS})
+
+# Slices with at least one request, missing counts are treated as none
+def has_requests(request_counts):
+    return (request_counts > 0).fillna(False).astype(bool)
+
+# Sum the usage into period buckets for each service with one vectorised groupby, a missing directory or type is kept
+# as its own group
+def aggregate(df, period):
+    df = df.assign(Period_Start=period_start(df['Time_Slice'], period), Active_Days=has_requests(df['Request_Count']).astype('int64'))
+    return (df.groupby(SERVICE_COLUMNS + ['Period_Start'], sort=True, dropna=False)
+              .agg(Request_Count=('Request_Count', 'sum'), Active_Days=('Active_Days', 'sum'))
+              .reset_index())
+
+# Sum a service rollup up to the directory or site level
+def sum_rollup(df, columns):
+    df = df.assign(Active_Services=has_requests(df['Request_Count']).astype('int64'))
+    return (df.groupby(columns + ['Period_Start'], sort=True, dropna=False)
+              .agg(Request_Count=('Request_Count', 'sum'), Services=('Service', 'size'), Active_Services=('Active_Services', 'sum'))
+              .reset_index())
+
+# Rows of a rollup whose (Site, Period_Start) is in buckets
+def in_buckets(df, buckets):
+    keys = pd.MultiIndex.from_arrays([df['Site'].astype(str), pd.to_datetime(df['Period_Start'])])
+    return keys.isin(list(buckets))
+
+# Fold new usage into the activity dates, the dates only move forward
+def update_activity(activity, usage):
+    usage = usage.assign(Active_Slice=usage['Time_Slice'].where(has_requests(usage['Request_Count'])))
+    new_activity = (usage.groupby(SERVICE_COLUMNS, sort=False, dropna=False)
+                         .agg(First_Slice=('Time_Slice', 'min'), Last_Slice=('Time_Slice', 'max'), Last_Request=('Active_Slice', 'max'))
+                         .reset_index())
+    if activity is not None:
+        new_activity = pd.concat([activity, new_activity], ignore_index=True)
+    return (new_activity.groupby(SERVICE_COLUMNS, sort=True, dropna=False)
+                        .agg(First_Slice=('First_Slice', 'min'), Last_Slice=('Last_Slice', 'max'), Last_Request=('Last_Request', 'max'))
+                        .reset_index())
+
+# Services with no requests in the last zero_days days of their site's history, or none at all
+def zero_traffic(activity, zero_days=DEFAULT_ZERO_DAYS):
+    as_of = activity.groupby('Site')['Last_Slice'].transform('max')
+    days = (as_of - activity['Last_Request']).dt.days
+    candidates = activity[activity['Last_Request'].isna() | (days >= zero_days)].copy()
+    candidates['As_Of'] = as_of[candidates.index]
+    candidates['Days_Since_Request'] = days[candidates.index].astype('Int64')
+    return candidates.sort_values(SERVICE_COLUMNS).reset_index(drop=True)
+
+# Update the rollups for the (site, YYYY-MM) partitions written to the usage store, or rebuild them all
+# when partitions is None
+def update_rollups(usage_root, rollup_root, partitions=None, zero_days=DEFAULT_ZERO_DAYS):
+    os.makedirs(rollup_root, exist_ok=True)
+
+    # The first update of a rollup directory (or one missing a table) has no history to fold the partitions into,
+    # so the rollups are built from the whole usage store instead
+    history = ['service_activity'] + [f"service_{period}" for period in PERIODS]
+    if partitions is not None and not all(os.path.exists(table_path(rollup_root, name)) for name in history):
+        print(f"\nNo rollups in '{rollup_root}' yet, building them from the whole usage store...")
+        partitions = None
+
+    if partitions is None:
+        usage = read_usage(usage_root)
+        usage = usage.astype({column: 'string' for column in SERVICE_COLUMNS}) if not usage.empty else usage
+        buckets = None
+        activity = None
+    else:
+        buckets = touched_buckets(partitions)
+        usage = read_partitions(usage_root, bucket_partitions(buckets))
+        activity = read_table(rollup_root, 'service_activity')
+
+    if usage.empty:
+        print("\nNo usage to roll up.")
+        return
+
+    for period in PERIODS:
+        rollup = aggregate(usage, period)
+        existing = read_table(rollup_root, f"service_{period}") if buckets else None
+        if existing is not None:
+            # Only the touched buckets are replaced, the partitions read for a week can hold slices of other weeks
+            rollup = rollup[in_buckets(rollup, buckets[period])]
+            rollup = pd.concat([existing[~in_buckets(existing, buckets[period])], rollup], ignore_index=True)
+            rollup = rollup.sort_values(SERVICE_COLUMNS + ['Period_Start']).reset_index(drop=True)
+        write_table(rollup, rollup_root, f"service_{period}")
+
+        # The directory and site rollups are summed from the service rollup
+        for level in ('directory', 'site'):
+            write_table(sum_rollup(rollup, LEVELS[level]), rollup_root, f"{level}_{period}")
+
+    activity = update_activity(activity, usage)
+    write_table(activity, rollup_root, 'service_activity')
+    write_table(zero_traffic(activity, zero_days), rollup_root, 'zero_traffic')
+
+    touched = f"{len(partitions)} partition(s)" if partitions is not None else "all partitions"
+    print(f"\nUsage rollups updated for {touched} under '{rollup_root}'")
+
+# CLICK cmds
+@click.command()
+@Instrument_ArcGISServer.instrumented
+@click.option('--parquet_dir', type=click.Path(exists=True), default=None, help='Partitioned Parquet usage store.')
+@click.option('--rollup_dir', type=click.Path(), default=None, help='Directory for the rollup tables.')
+@click.option('--rebuild', is_flag=True, default=False, help='Rebuild every rollup from the whole usage store.')
+@click.option('--zero_days', type=click.IntRange(min=1), default=DEFAULT_ZERO_DAYS, help='Days without requests before a service is a zero-traffic candidate.')
+@click.option('--out_csv', type=click.Path(), default=None, help='Also save the zero-traffic candidates to this CSV.')
+
+def main(parquet_dir, rollup_dir, rebuild, zero_days, out_csv):
+    default_parquet = r"..."
+    parquet_dir = parquet_dir if parquet_dir else default_parquet
+
+    default_rollup = r"..."
+    rollup_dir = rollup_dir if rollup_dir else default_rollup
+
+    activity = None if rebuild else read_table(rollup_dir, 'service_activity')
+    if activity is None:
+        with Instrument_ArcGISServer.span('rollup', rollup_dir):
+            update_rollups(parquet_dir, rollup_dir, zero_days=zero_days)
+        activity = read_table(rollup_dir, 'service_activity')
+
+    # An empty or missing usage store leaves nothing to report on
+    if activity is None:
+        print(f"\nNo service activity in '{rollup_dir}', zero-traffic candidates not saved.")
+        return
+
+    candidates = zero_traffic(activity, zero_days)
+    write_table(candidates, rollup_dir, 'zero_traffic')
+    print(f"\n{len(candidates)} service(s) with no requests for {zero_days} days")
+
+    if out_csv:
+        candidates.to_csv(out_csv, index=False, date_format='%Y-%m-%d')
+        print(f"\nCSV saved as: {out_csv}")
+
+if __name__ == '__main__':
+    main()
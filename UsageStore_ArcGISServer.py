@@ -0,0 +1,73 @@
+'''
+This script is the Parquet store for ArcGIS Server usage history. Usage rows are kept as typed, compressed Parquet
+partitioned by site and month, with categorical Site/Directory/Service/Service_Type columns, e.g.
+
+    usage/site=ags1/month=2024-05/usage.parquet
+
+New rows are merged and de-duplicated per partition, so only the partitions touched by a report are rewritten and
+readers (Power BI or other scripts) only need to load the partitions they use.
+Use with conjunction in other scripts.
+
+Requirements: Python 3+, pandas, pyarrow
+'''
+import os
+import pandas as pd
+
+KEY_COLUMNS = ['Site', 'Directory', 'Service', 'Service_Type', 'Time_Slice']
+CATEGORY_COLUMNS = ['Site', 'Directory', 'Service', 'Service_Type']
+DATE_FORMAT = '%Y-%m-%d'
+
+# Cast usage rows to the stored types
+def to_typed(df):
+    df = df.copy()
+    if not pd.api.types.is_datetime64_any_dtype(df['Time_Slice']):
+        df['Time_Slice'] = pd.to_datetime(df['Time_Slice'], format=DATE_FORMAT)
+    df['Request_Count'] = pd.to_numeric(df['Request_Count']).astype('Int64')
+    # Values are cast to text through the nullable string dtype, so missing values stay missing instead of becoming 'nan'
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('string').astype('category')
+    return df
+
+def partition_path(root, site, month):
+    return os.path.join(root, f"site={site}", f"month={month}", "usage.parquet")
+
+# Merge usage rows into the store, only the site/month partitions in the rows are read and rewritten.
+# Returns the (site, YYYY-MM) partitions that were written.
+def write_usage(df, root):
+    df = to_typed(df)
+    months = df['Time_Slice'].dt.strftime('%Y-%m')
+    partitions = []
+
+    for (site, month), part in df.groupby([df['Site'].astype(str), months], sort=True):
+        path = partition_path(root, site, month)
+        if os.path.exists(path):
+            part = pd.concat([pd.read_parquet(path), part.astype({column: 'string' for column in CATEGORY_COLUMNS})])
+
+        # The latest report wins for a slice that is already stored
+        part = to_typed(part).drop_duplicates(subset=KEY_COLUMNS, keep='last').sort_values(KEY_COLUMNS)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part.to_parquet(f"{path}.tmp", engine='pyarrow', compression='snappy', index=False)
+        os.replace(f"{path}.tmp", path)
+        partitions.append((site, month))
+
+    print(f"\nUsage merged into {len(partitions)} partition(s) under '{root}'")
+    return partitions
+
+# Read usage rows from the store, optionally limited to some sites and months (YYYY-MM)
+def read_usage(root, sites=None, months=None):
+    parts = []
+    for site_dir in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        site = site_dir.split('=', 1)[-1]
+        if sites and site not in sites:
+            continue
+        for month_dir in sorted(os.listdir(os.path.join(root, site_dir))):
+            month = month_dir.split('=', 1)[-1]
+            path = partition_path(root, site, month)
+            if (months and month not in months) or not os.path.exists(path):
+                continue
+            parts.append(pd.read_parquet(path))
+
+    if not parts:
+        return pd.DataFrame(columns=KEY_COLUMNS + ['Request_Count'])
+    return to_typed(pd.concat([part.astype({column: 'string' for column in CATEGORY_COLUMNS}) for part in parts], ignore_index=True))